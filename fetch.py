@@ -0,0 +1,1186 @@
+#! /usr/bin/python
+
+# This module contains the download layer shared by the Doppler Value Investing scripts.
+# It fetches pages from the upstream web sites (Smartmoney, Yahoo Finance, NASDAQ) and saves them locally.
+
+import os
+import datetime
+import urllib2
+import urlparse
+import httplib
+import socket
+import time, random
+import threading
+import Queue
+import json
+import fcntl
+import zlib
+
+import pagestore
+
+# Get age of a stored page (see pagestore.page_mtime)
+# Based on solution at
+# http://stackoverflow.com/questions/5799070/how-to-see-if-file-is-older-than-3-months-in-python
+# Returns a billion if the page does not exist
+def age_of_page (file_name): # In hours
+    t_modified = pagestore.page_mtime (file_name)
+    if t_modified == None:
+        return 1000000000
+    age = datetime.datetime.now () - datetime.datetime.fromtimestamp (t_modified)
+    return 24 * age.days + age.seconds/3600
+
+# OFFLINE MODE
+# After go_offline, download_page never opens a connection: every page is read from the local store, whatever its age,
+# and a page that is not stored counts as missing data.
+offline = False
+n_offline_missing = 0 # Pages requested while offline that are not stored locally
+lock_offline = threading.Lock ()
+
+# Purpose: switch to offline mode for the rest of the run
+def go_offline ():
+    global offline
+    offline = True
+
+# Purpose: report the pages that were missing while offline
+# Output: string
+def offline_stats ():
+    return "Offline mode: " + str(n_offline_missing) + " pages not stored locally"
+
+# Headers sent with every request (the same User-Agent as urllib2)
+# The pages are asked for compressed; Response decodes them as they arrive.
+DICT_HEADERS_DEFAULT = {'User-Agent': 'Python-urllib/' + urllib2.__version__, 'Accept-Encoding': 'gzip, deflate'}
+N_REDIRECTS_MAX = 5
+
+# COMPRESSION
+# Servers that honor Accept-Encoding send the pages gzip- or deflate-compressed (Content-Encoding), which makes
+# the statement pages and exchange lists several times smaller on the wire.  The body is decoded piece by piece as
+# it is read, so the rest of the download layer only ever sees the plain page.
+# The bytes received by each host are counted both as sent (on the wire) and as decoded.
+dict_bytes = {} # Host -> [bytes on the wire, bytes decoded]
+lock_bytes = threading.Lock ()
+
+# This defines the class Decoder (encoding).
+# It decompresses a body compressed with the given Content-Encoding (gzip or deflate), one piece at a time.
+# "deflate" is supposed to be zlib-wrapped, but some servers send raw deflate data; both are accepted.
+class Decoder:
+    def __init__ (self, encoding):
+        self.encoding = encoding
+        self.is_start = True
+        if encoding == 'deflate':
+            self.obj = zlib.decompressobj ()
+        else:
+            self.obj = zlib.decompressobj (16 + zlib.MAX_WBITS) # gzip header and trailer
+
+    # Purpose: decode the next piece of the body
+    # Inputs: string (compressed piece), True if this is the end of the body
+    # Output: string (decoded data; may be empty until enough compressed data has arrived)
+    def decode (self, data, is_end):
+        if self.is_start and data != '':
+            self.is_start = False
+            if self.encoding == 'deflate':
+                try:
+                    return self.decode (data, is_end)
+                except zlib.error:
+                    self.obj = zlib.decompressobj (-zlib.MAX_WBITS) # Raw deflate
+        data_out = self.obj.decompress (data)
+        if is_end:
+            data_out = data_out + self.obj.flush ()
+        return data_out
+
+# Purpose: get the decoder for a response body
+# Input: string (Content-Encoding header, or None)
+# Output: Decoder (None if the body is not compressed, or compressed in a way that is not supported)
+def decoder_for (encoding):
+    encoding = (encoding or '').strip ().lower ()
+    if encoding == 'gzip' or encoding == 'x-gzip':
+        return Decoder ('gzip')
+    if encoding == 'deflate':
+        return Decoder ('deflate')
+    return None
+
+# Purpose: report the bytes received from each host, on the wire and decoded
+# Output: string
+def transfer_stats ():
+    with lock_bytes:
+        if dict_bytes == {}:
+            return "Bytes received: none"
+        list_parts = []
+        for host in sorted (dict_bytes):
+            n_wire, n_decoded = dict_bytes [host]
+            str_part = host + ": " + '{0:.2f}'.format (n_wire / 1048576.0) + " MB on the wire, " + '{0:.2f}'.format (n_decoded / 1048576.0) + " MB decoded"
+            if n_decoded > 0:
+                str_part = str_part + " (" + '{0:.0f}'.format (100.0 * (n_decoded - n_wire) / n_decoded) + "% saved)"
+            list_parts.append (str_part)
+        return "Bytes received: " + ", ".join (list_parts)
+
+# This defines the class Response (pool, key, conn, response, url).
+# It is returned by ConnectionPool.open and behaves like the object returned by urllib2.urlopen.
+# A compressed body is decoded as it is read (see COMPRESSION); n_bytes_wire counts the bytes as sent by the server.
+# The connection goes back to the pool once the body has been read to the end.
+class Response:
+    def __init__ (self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.code = response.status
+        self.decoder = decoder_for (response.getheader ('Content-Encoding'))
+        self.n_bytes_wire = 0
+
+    # Purpose: get the HTTP response headers
+    # Output: httplib.HTTPMessage
+    def info (self):
+        return self.response.msg
+
+    def geturl (self):
+        return self.url
+
+    # Purpose: read the body (all of it if n_bytes is None)
+    # n_bytes counts the bytes on the wire, so a compressed body gives more than n_bytes bytes at a time.
+    # Only the end of the body gives an empty string.
+    # Output: string
+    def read (self, n_bytes = None):
+        while self.conn != None:
+            if n_bytes == None:
+                data = self.response.read ()
+            else:
+                data = self.response.read (n_bytes)
+            is_end = (n_bytes == None or data == '')
+            if is_end:
+                self.release ()
+            self.n_bytes_wire = self.n_bytes_wire + len (data)
+            n_bytes_wire = len (data)
+            if self.decoder != None:
+                data = self.decoder.decode (data, is_end)
+            with lock_bytes:
+                list_bytes = dict_bytes.setdefault (url_host (self.url), [0, 0])
+                list_bytes [0] = list_bytes [0] + n_bytes_wire
+                list_bytes [1] = list_bytes [1] + len (data)
+            if data != '' or is_end:
+                return data
+        return ''
+
+    # Purpose: give the connection back to the pool, or close it if the server will close it anyway
+    def release (self):
+        if self.conn == None:
+            return
+        if self.response.will_close:
+            self.conn.close ()
+        else:
+            self.pool.put_connection (self.key, self.conn)
+        self.conn = None
+
+    # Purpose: stop reading; a connection with unread data cannot be reused, so it is closed
+    def close (self):
+        if self.conn != None:
+            self.conn.close ()
+            self.conn = None
+
+# This defines the class ConnectionPool (timeout, n_idle_max).
+# It keeps connections to each host open between requests (HTTP keep-alive)
+# and remembers the IP address of each host, so DNS lookups and TCP handshakes are not repeated.
+# One pool can be shared by all of the threads of a Downloader.
+# timeout: seconds to wait on a connection before giving up
+# n_idle_max: maximum number of idle connections kept for each host
+class ConnectionPool:
+    def __init__ (self, timeout = 10, n_idle_max = 8):
+        self.timeout = timeout
+        self.n_idle_max = n_idle_max
+        self.lock = threading.Lock ()
+        self.dict_idle = {} # (scheme, host, port) -> list of idle connections
+        self.dict_addr = {} # (host, port) -> IP address
+        self.n_hits = 0 # Requests sent on a reused connection
+        self.n_misses = 0 # Requests that needed a new connection
+        self.n_dns_hits = 0
+        self.n_dns_misses = 0
+
+    # Purpose: get the IP address of a host, looking it up only the first time
+    # Inputs: string (host name), integer (port)
+    # Output: string (IP address)
+    def address (self, host, port):
+        with self.lock:
+            if (host, port) in self.dict_addr:
+                self.n_dns_hits = self.n_dns_hits + 1
+                return self.dict_addr [(host, port)]
+        list_info = socket.getaddrinfo (host, port, 0, socket.SOCK_STREAM)
+        list_info.sort (key = lambda info: info [0] != socket.AF_INET) # Prefer IPv4
+        addr = list_info [0][4][0]
+        with self.lock:
+            self.n_dns_misses = self.n_dns_misses + 1
+            self.dict_addr [(host, port)] = addr
+        return addr
+
+    # Purpose: get a connection to a host, reusing an idle one if possible
+    # Input: (scheme, host, port)
+    # Outputs: connection, True if the connection was reused
+    def get_connection (self, key):
+        with self.lock:
+            list_idle = self.dict_idle.get (key, [])
+            if len (list_idle) > 0:
+                self.n_hits = self.n_hits + 1
+                return list_idle.pop (), True
+            self.n_misses = self.n_misses + 1
+        scheme, host, port = key
+        if scheme == 'https':
+            # Connect by name so that the certificate can be checked against it
+            conn = httplib.HTTPSConnection (host, port, timeout = self.timeout)
+        else:
+            conn = httplib.HTTPConnection (self.address (host, port), port, timeout = self.timeout)
+        return conn, False
+
+    # Purpose: return a connection to the pool after its response has been read
+    # Inputs: (scheme, host, port), connection
+    def put_connection (self, key, conn):
+        with self.lock:
+            list_idle = self.dict_idle.setdefault (key, [])
+            if len (list_idle) < self.n_idle_max:
+                list_idle.append (conn)
+                return
+        conn.close ()
+
+    # Purpose: close all idle connections (for example at the end of a run, so the servers see the clients go)
+    def close_idle (self):
+        with self.lock:
+            list_conns = []
+            for key in self.dict_idle:
+                list_conns = list_conns + self.dict_idle [key]
+            self.dict_idle = {}
+        for conn in list_conns:
+            conn.close ()
+
+    # Purpose: send a GET request on a pooled connection
+    # A reused connection may have been closed by the server in the meantime; the request is then sent again
+    # on a new connection.
+    # Inputs: string (URL), dict of extra HTTP headers
+    # Output: Response
+    def get (self, url, dict_headers):
+        parts = urlparse.urlsplit (url)
+        scheme = parts.scheme.lower ()
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname.lower (), port)
+        path = parts.path or '/'
+        if parts.query:
+            path = path + '?' + parts.query
+        dict_send = dict (DICT_HEADERS_DEFAULT)
+        dict_send.update (dict_headers)
+        dict_send ['Host'] = parts.netloc
+        while True:
+            conn, reused = self.get_connection (key)
+            try:
+                conn.request ('GET', path, headers = dict_send)
+                response = conn.getresponse ()
+                return Response (self, key, conn, response, url)
+            except (httplib.HTTPException, socket.error), e:
+                conn.close ()
+                if reused and not isinstance (e, socket.timeout):
+                    continue
+                raise
+
+    # Purpose: download a URL, following redirects
+    # Errors are reported the same way as urllib2.urlopen: urllib2.HTTPError for error statuses
+    # (including 304 Not Modified) and urllib2.URLError when the server cannot be reached.
+    # Inputs: string (URL), dict of extra HTTP headers
+    # Output: Response
+    def open (self, url, dict_headers = None):
+        dict_headers = dict_headers or {}
+        n_redirects = 0
+        while True:
+            try:
+                f = self.get (url, dict_headers)
+            except (httplib.HTTPException, socket.error), e:
+                raise urllib2.URLError (e)
+            if f.code in (301, 302, 303, 307) and n_redirects < N_REDIRECTS_MAX:
+                location = f.info ().getheader ('Location')
+                f.read ()
+                if location:
+                    url = urlparse.urljoin (url, location)
+                    n_redirects = n_redirects + 1
+                    continue
+            if f.code >= 300:
+                f.read ()
+                raise urllib2.HTTPError (url, f.code, f.response.reason, f.info (), None)
+            return f
+
+    # Purpose: summarize how well the connections and DNS lookups were reused
+    # Output: string
+    def stats (self):
+        str_output = "Connections: " + str(self.n_hits) + " reused, " + str(self.n_misses) + " new; "
+        str_output = str_output + "DNS lookups: " + str(self.n_dns_hits) + " cached, " + str(self.n_dns_misses) + " new"
+        return str_output
+
+pool = ConnectionPool () # Shared by all downloads in this process
+
+# RETRIES
+# A failed download is tried again after a random delay between half and all of
+# SECONDS_BACKOFF_BASE * 2^(number of failures - 1), up to SECONDS_BACKOFF_MAX.
+# "Not found" is final and is not tried again.
+SECONDS_BACKOFF_BASE = 2
+SECONDS_BACKOFF_MAX = 60
+dict_n_retries = {} # Host -> number of attempts after a failure
+lock_retries = threading.Lock ()
+
+# Purpose: get the delay before the next attempt at a download
+# Input: integer (number of failures so far)
+# Output: number of seconds
+def backoff_seconds (n_fail):
+    seconds_max = min (SECONDS_BACKOFF_MAX, SECONDS_BACKOFF_BASE * 2 ** (n_fail - 1))
+    return random.uniform (seconds_max / 2.0, seconds_max)
+
+# Purpose: report the attempts made after a failure
+# Output: string
+def retry_stats ():
+    with lock_retries:
+        if dict_n_retries == {}:
+            return "Retries: none"
+        list_parts = []
+        for host in sorted (dict_n_retries):
+            list_parts.append (host + ": " + str(dict_n_retries [host]))
+        return "Retries: " + ", ".join (list_parts)
+
+# This defines the class CircuitBreaker (n_fail_max, seconds_cooldown).
+# When a host fails n_fail_max times in a row (server errors, throttling, timeouts), it is considered down and no
+# requests are sent to it for seconds_cooldown seconds.  Downloads from that host are skipped in the meantime, so
+# the local copies are used.  After the cool-down, one more failure opens the breaker again; a success closes it.
+class CircuitBreaker:
+    def __init__ (self, n_fail_max, seconds_cooldown):
+        self.n_fail_max = n_fail_max
+        self.seconds_cooldown = seconds_cooldown
+        self.lock = threading.Lock ()
+        self.dict_fail = {} # Host -> number of failures in a row
+        self.dict_open = {} # Host -> time until which the host is skipped
+        self.dict_skipped = {} # Host -> number of downloads skipped
+
+    # Purpose: determine whether a request may be sent to a host
+    # Input: string (host name)
+    # Output: True or False
+    def allow (self, host):
+        with self.lock:
+            if time.time () < self.dict_open.get (host, 0):
+                self.dict_skipped [host] = self.dict_skipped.get (host, 0) + 1
+                return False
+            return True
+
+    # Purpose: record a successful request
+    # Input: string (host name)
+    def success (self, host):
+        with self.lock:
+            self.dict_fail [host] = 0
+            if host in self.dict_open:
+                del self.dict_open [host]
+
+    # Purpose: record a failed request, opening the breaker after too many failures in a row
+    # Input: string (host name)
+    def failure (self, host):
+        with self.lock:
+            n_fail = self.dict_fail.get (host, 0) + 1
+            self.dict_fail [host] = n_fail
+            if n_fail >= self.n_fail_max:
+                self.dict_open [host] = time.time () + self.seconds_cooldown
+        if n_fail == self.n_fail_max:
+            print "Too many failures in a row - skipping " + host + " for " + str(self.seconds_cooldown) + " seconds"
+
+    # Purpose: summarize the downloads skipped because a host was down
+    # Output: string
+    def stats (self):
+        with self.lock:
+            list_parts = []
+            for host in sorted (self.dict_skipped):
+                list_parts.append (host + ": " + str(self.dict_skipped [host]))
+        if len (list_parts) == 0:
+            return "Downloads skipped because a host was down: none"
+        return "Downloads skipped because a host was down: " + ", ".join (list_parts)
+
+breaker = CircuitBreaker (10, 600) # Shared by all downloads in this process
+
+# RATE CONTROL
+# Each host gets its own request rate (requests/second), adjusted the way TCP adjusts its sending rate:
+# every quick, successful response raises the rate a little (additive increase), while every sign of overload
+# ("429 Too Many Requests", "503 Service Unavailable", a timeout) cuts it in half (multiplicative decrease).
+# Slow responses (more than SECONDS_LATENCY_SLOW) hold the rate where it is.
+RATE_START = 5.0
+RATE_MIN = 0.2
+RATE_MAX = 50.0
+RATE_STEP = 0.1 # Increase per second's worth of good responses
+RATE_CUT = 0.5
+SECONDS_LATENCY_SLOW = 2.0
+RATE_RESUME = 0.9 # Fraction of the saved rate used at the start of the next run
+
+# This defines the class RateController ().
+# It spaces out the requests to each host according to the host's current rate.
+# The rates learned in one run can be saved and used as the starting point of the next run.
+class RateController:
+    def __init__ (self):
+        self.lock = threading.Lock ()
+        self.dict_rate = {} # Host -> requests/second
+        self.dict_next = {} # Host -> earliest time of the next request
+
+    # Purpose: get the current rate for a host
+    # Input: string (host name)
+    # Output: requests/second
+    def rate (self, host):
+        with self.lock:
+            return self.dict_rate.get (host, RATE_START)
+
+    # Purpose: wait until the next request to a host is allowed
+    # Input: string (host name)
+    def wait (self, host):
+        with self.lock:
+            now = time.time ()
+            t = max (now, self.dict_next.get (host, now))
+            self.dict_next [host] = t + 1.0 / self.dict_rate.get (host, RATE_START)
+        if t > now:
+            time.sleep (t - now)
+
+    # Purpose: record a response that did not indicate overload
+    # Inputs: string (host name), number (seconds from request to end of response)
+    def success (self, host, seconds_latency):
+        if seconds_latency > SECONDS_LATENCY_SLOW:
+            return
+        with self.lock:
+            rate = self.dict_rate.get (host, RATE_START)
+            self.dict_rate [host] = min (RATE_MAX, rate + RATE_STEP / rate)
+
+    # Purpose: record a sign of overload (429, 503, timeout) and slow down
+    # Inputs: string (host name), optional number of seconds to hold off (from a Retry-After header)
+    def overload (self, host, seconds_retry = None):
+        with self.lock:
+            rate = self.dict_rate.get (host, RATE_START)
+            self.dict_rate [host] = max (RATE_MIN, rate * RATE_CUT)
+            if seconds_retry != None:
+                self.dict_next [host] = max (self.dict_next.get (host, 0), time.time () + seconds_retry)
+
+    # Purpose: start from the rates saved by the previous run
+    # Input: string (path of the JSON file)
+    def load (self, file_name):
+        try:
+            with open (file_name, 'r') as f:
+                dict_saved = json.load (f)
+        except:
+            return
+        with self.lock:
+            for host in dict_saved:
+                rate = float (dict_saved [host]) * RATE_RESUME
+                self.dict_rate [host] = min (RATE_MAX, max (RATE_MIN, rate))
+
+    # Purpose: save the current rates for the next run
+    # Input: string (path of the JSON file)
+    def save (self, file_name):
+        with self.lock:
+            dict_saved = dict (self.dict_rate)
+        file_tmp = file_name + '.tmp'
+        with open (file_tmp, 'w') as f:
+            json.dump (dict_saved, f)
+        os.rename (file_tmp, file_name)
+
+    # Purpose: summarize the current rates
+    # Output: string
+    def stats (self):
+        with self.lock:
+            list_parts = []
+            for host in sorted (self.dict_rate):
+                list_parts.append (host + ": " + '{0:.1f}'.format (self.dict_rate [host]))
+        return "Request rates (requests/second): " + ", ".join (list_parts)
+
+rates = RateController () # Shared by all downloads in this process
+
+# NIGHT WINDOW
+# pace_until spreads the requests of the rest of the run evenly over the time left until a given end, so the upstream
+# servers see a steady trickle instead of a burst.  The first request goes out at once.
+# The pacer is told how many pages are waiting (Downloader.add) and how many are finished.  The requests still to come
+# are estimated from what happened so far: how many requests a page needed (pages that are still new enough cost
+# none), and how many pages were added per page finished (later stages of screen.py add pages as they go).
+# Only the pages added after some pages are finished count as added by later stages, and the requests made while no
+# pages are waiting (the exchange lists, before the Downloader starts) are neither paced nor counted.
+# So the spacing adjusts as the remaining work changes.  The requests aim to be done PACE_MARGIN of the time left
+# before the end, and each gap varies by up to PACE_JITTER either way.
+# The per-host limits of RateController still apply.
+PACE_JITTER = .5
+PACE_MARGIN = .1
+
+# This defines the class WindowPacer (t_end).
+# Input: time in seconds since the epoch by which the requests should be done
+class WindowPacer:
+    def __init__ (self, t_end):
+        self.t_end = t_end
+        self.lock = threading.Lock ()
+        self.n_pending = 0 # Pages waiting to be downloaded or checked
+        self.n_finished = 0
+        self.n_added_late = 0 # Pages added once some pages were finished (by the later stages)
+        self.n_requests = 0 # Requests paced (made while pages were waiting)
+        self.t_next = time.time () # Time of the next free slot
+
+    # Purpose: count pages added to the work
+    # Input: number of pages
+    def add (self, n_pages):
+        with self.lock:
+            self.n_pending = self.n_pending + n_pages
+            if self.n_finished > 0:
+                self.n_added_late = self.n_added_late + n_pages
+
+    # Purpose: count a page that is finished, whether or not it needed a request
+    def finished (self):
+        with self.lock:
+            self.n_pending = self.n_pending - 1
+            self.n_finished = self.n_finished + 1
+
+    # Purpose: wait for the next slot before sending a request
+    # Requests made while no pages are waiting (outside the Downloader) are not paced.
+    def wait (self):
+        with self.lock:
+            if self.n_pending <= 0:
+                return
+            self.n_requests = self.n_requests + 1
+            now = time.time ()
+            ratio = 1.0 # Requests per page, until there is some experience
+            ratio_added = 0.0 # Pages added per page finished
+            if self.n_finished > 0:
+                ratio = float (self.n_requests) / self.n_finished
+                ratio_added = float (self.n_added_late) / self.n_finished
+            n_requests_left = max (1.0, self.n_pending * (1 + ratio_added) * ratio)
+            interval = max (0, self.t_end - now) * (1 - PACE_MARGIN) / n_requests_left
+            t_slot = max (now, self.t_next)
+            self.t_next = t_slot + interval * random.uniform (1 - PACE_JITTER, 1 + PACE_JITTER)
+        if t_slot > now:
+            time.sleep (t_slot - now)
+
+    # Purpose: report the pacing
+    # Output: string
+    def stats (self):
+        with self.lock:
+            n_minutes_left = (self.t_end - time.time ()) / 60
+            return "Night window: " + str(self.n_requests) + " requests, ending " + '{0:.0f}'.format (n_minutes_left) + " minutes from now"
+
+pacer = None # The WindowPacer, once pace_until is called
+
+# Purpose: spread the requests of the rest of the run until a given time
+# Input: time in seconds since the epoch
+def pace_until (t_end):
+    global pacer
+    pacer = WindowPacer (t_end)
+
+# Purpose: determine whether an error means that the server is overloaded
+# Input: exception
+# Output: True or False
+def is_overload (e):
+    if isinstance (e, urllib2.HTTPError):
+        return e.code in (429, 503)
+    if isinstance (e, urllib2.URLError):
+        return isinstance (e.reason, socket.timeout)
+    return isinstance (e, socket.timeout)
+
+# Purpose: get the delay requested by a Retry-After header (in seconds only)
+# Input: urllib2.HTTPError
+# Output: number of seconds (None if there is no usable header)
+def retry_after (e):
+    try:
+        return float (e.info ().getheader ('Retry-After'))
+    except:
+        return None
+
+# Size of the pieces in which a response is read and saved
+N_BYTES_CHUNK = 64 * 1024
+
+# Pages up to this size are also kept in memory and returned by download_page, so they can be parsed without
+# reading them back from disk; larger pages (the exchange lists) are only saved.
+N_BYTES_KEEP_MAX = 1024 * 1024
+
+# Number of bytes at the start of a page that are kept for validation when the page is too large to keep in memory
+N_BYTES_HEAD = 64 * 1024
+
+class IncompleteDownload (Exception):
+    pass
+
+# PAGE VALIDATION
+# A page can arrive complete and still be useless: a throttling or "access denied" page, a login wall, a template
+# with an empty table.  The caller of download_page can pass a validator, a function (local file, text) that returns
+# the reason a page is not valid (None if it is).  The text is the whole page, or its first N_BYTES_HEAD bytes if the
+# page is too large to keep in memory.  An invalid page is never saved: the local copy is kept.
+# An invalid page that contains a marker in LIST_THROTTLE_MARKERS is a throttling page: the server is pushing back,
+# so it counts as a failure of the host (see CircuitBreaker), the host's request rate is cut, and the download is
+# tried again like any failed one.  The markers are only looked for in pages the validator rejected, so a valid page
+# that happens to contain one is saved as usual.  Any other invalid page (a login wall, an empty template) would only
+# come back the same in this run, so the download gives up at once: the page is journaled as OUTCOME_INVALID and held
+# back by the pagestore.NegativeCache for a short time (NegativeCache.add_invalid), then tried again.
+LIST_THROTTLE_MARKERS = [
+    'Too Many Requests',
+    'rate limit',
+    'Rate Limit',
+    'unusual traffic',
+    'temporarily unavailable',
+]
+REASON_THROTTLED = 'throttling page'
+dict_n_invalid = {} # Reason -> number of pages rejected
+lock_invalid = threading.Lock ()
+
+class InvalidPage (Exception):
+    pass
+
+# Purpose: determine whether a page is a throttling page
+# Input: text of the page
+# Output: True or False
+def is_throttle_page (text):
+    for marker in LIST_THROTTLE_MARKERS:
+        if marker in text:
+            return True
+    return False
+
+# Purpose: report the pages rejected by the validators
+# Output: string
+def invalid_stats ():
+    with lock_invalid:
+        if dict_n_invalid == {}:
+            return "Invalid pages rejected: none"
+        list_str = []
+        for reason in sorted (dict_n_invalid):
+            list_str.append (reason + ": " + str(dict_n_invalid [reason]))
+        return "Invalid pages rejected: " + ', '.join (list_str)
+
+# Purpose: check that a downloaded file is an exchange list (validator for download_page)
+# Inputs: local file, text of the page
+# Output: reason why the page is not valid (None if it is)
+def validate_exchange_list (file_name, text):
+    line_header = text.split ('\n', 1) [0]
+    if not ('Symbol' in line_header and 'LastSale' in line_header and 'MarketCap' in line_header):
+        return 'not an exchange list'
+    return None
+
+# Purpose: read a response piece by piece and pass the pieces to a pagestore.PageWriter
+# Raises IncompleteDownload if fewer bytes arrive than the Content-Length header announced (for a compressed page,
+# the Content-Length is that of the compressed body, so it is compared with the bytes on the wire).
+# Inputs: Response, pagestore.PageWriter
+# Output: (contents of the page if it is no larger than N_BYTES_KEEP_MAX, otherwise None,
+# first N_BYTES_HEAD bytes of the page)
+def receive_page (f, writer):
+    list_chunks = []
+    head = ''
+    while True:
+        chunk = f.read (N_BYTES_CHUNK)
+        if chunk == '':
+            break
+        writer.write (chunk)
+        if len (head) < N_BYTES_HEAD:
+            head = head + chunk [:N_BYTES_HEAD - len (head)]
+        if list_chunks != None:
+            list_chunks.append (chunk)
+            if writer.n_bytes > N_BYTES_KEEP_MAX:
+                list_chunks = None
+    try:
+        n_bytes_expected = int (f.info ().getheader ('Content-Length'))
+    except (TypeError, ValueError):
+        n_bytes_expected = None
+    if n_bytes_expected != None and f.n_bytes_wire != n_bytes_expected:
+        raise IncompleteDownload ("Incomplete download: " + str(f.n_bytes_wire) + " of " + str(n_bytes_expected) + " bytes")
+    if list_chunks == None:
+        return (None, head)
+    return (''.join (list_chunks), head)
+
+# Download a page from a url and save it
+# Only download if the existing page is older than file_age_max_hours.
+# An old page is revalidated with a conditional request (ETag/Last-Modified from its metadata file).
+# If the server answers "304 Not Modified", the local copy is kept and counts as new again.
+# If the download is not successful, make up to 2 additional attempts, waiting longer before each one (backoff_seconds).
+# If the host is down (see CircuitBreaker), the download is skipped and the local copy (if any) is used.
+# Requests to each host are spaced out according to its current rate (see RateController).
+# In offline mode (see go_offline), nothing is downloaded and the local copy is always used.
+# Inputs: URL of source, path of destination, maximum age in hours,
+# pagestore.FORMAT_PLAIN or pagestore.FORMAT_GZIP (read the page back with pagestore.read_page),
+# optional pagestore.Journal (pages already finished in an interrupted run are skipped; outcomes are recorded),
+# optional pagestore.NegativeCache (pages known not to exist or held back are skipped; newly found ones are added),
+# optional validator (see PAGE VALIDATION; invalid pages are not saved, and only throttling pages are tried again)
+# Output: contents of the page if it was downloaded (and no larger than N_BYTES_KEEP_MAX),
+# None if the local file was kept or the download failed
+# The page is saved as it arrives and only replaces the local copy once it is complete (see pagestore.PageWriter).
+# A page that turns out not to exist (empty, or a "not found" message) is not saved.
+# Requests go through the shared connection pool and time out after 10 seconds.
+# Pages are asked for compressed and decoded as they arrive (see COMPRESSION).
+# Call download_page rather than fetch_page, so that the same page is never fetched twice in a run (see SingleFlight).
+def fetch_page (url, file_name, file_age_max_hours, page_format = pagestore.FORMAT_PLAIN, journal = None, negative_cache = None, validator = None):
+    global n_offline_missing
+    contents = None
+    if offline:
+        if pagestore.page_size (file_name) == 0:
+            with lock_offline:
+                n_offline_missing = n_offline_missing + 1
+        return contents
+    if journal != None and journal.finished (url):
+        print "Already finished before the interruption - skipping download"
+        return contents
+    if negative_cache != None and negative_cache.missing (url):
+        print "Page known not to exist - skipping download"
+        return contents
+    outcome = None
+    host = url_host (url)
+    file_age = age_of_page (file_name) # In hours
+    file_size = pagestore.page_size (file_name)
+    n_fail = 0
+    n_fail_max = 2
+    while ((file_age > file_age_max_hours or file_size == 0) and n_fail <= n_fail_max):
+        if n_fail > 0:
+            time.sleep (backoff_seconds (n_fail))
+            with lock_retries:
+                dict_n_retries [host] = dict_n_retries.get (host, 0) + 1
+        if not breaker.allow (host):
+            print "Host is down - keeping local file:", url
+            outcome = pagestore.OUTCOME_FAILED
+            break
+        if pacer != None:
+            pacer.wait () # Spreads the requests over the night window
+        rates.wait (host) # Limits the impact on the upstream server
+        t_request = time.time ()
+        writer = None
+        try:
+            f = pool.open (url, pagestore.conditional_headers (url, file_name))
+            writer = pagestore.PageWriter (file_name, page_format)
+            contents, head = receive_page (f, writer)
+            seconds_latency = time.time () - t_request
+            if negative_cache != None and contents != None and negative_cache.is_missing_page (contents):
+                rates.success (host, seconds_latency)
+                breaker.success (host)
+                writer.discard ()
+                negative_cache.add (url)
+                print "Page not found, giving up"
+                contents = None
+                outcome = pagestore.OUTCOME_NOT_FOUND
+                break
+            if validator != None:
+                text = contents if contents != None else head
+                reason = validator (file_name, text)
+                if reason != None and is_throttle_page (text):
+                    reason = REASON_THROTTLED
+                if reason != None:
+                    raise InvalidPage (reason)
+            rates.success (host, seconds_latency)
+            breaker.success (host)
+            if negative_cache != None:
+                negative_cache.remove (url)
+            writer.commit ()
+            pagestore.record_download (url, file_name, writer.digest (), f.info ())
+            outcome = pagestore.OUTCOME_OK
+            break # Script hangs without this command
+        except urllib2.HTTPError, e:
+            if writer != None:
+                writer.discard ()
+            if e.code == 304:
+                rates.success (host, time.time () - t_request)
+                pagestore.record_not_modified (file_name)
+                print "Not modified - keeping local file"
+                outcome = pagestore.OUTCOME_OK
+                breaker.success (host)
+                break
+            n_fail = n_fail + 1
+            print "Failure #: " + str (n_fail)
+            print "HTTP Error:",e.code , url
+            if e.code in (404, 410):
+                rates.success (host, time.time () - t_request)
+                breaker.success (host) # The host is up; the page just does not exist
+                if negative_cache != None:
+                    negative_cache.add (url)
+                print "Page not found, giving up"
+                outcome = pagestore.OUTCOME_NOT_FOUND
+                break
+            if is_overload (e):
+                rates.overload (host, retry_after (e))
+            breaker.failure (host)
+        except InvalidPage, e:
+            writer.discard ()
+            contents = None
+            print "Invalid page (" + str(e) + "):", url
+            with lock_invalid:
+                dict_n_invalid [str(e)] = dict_n_invalid.get (str(e), 0) + 1
+            if str(e) != REASON_THROTTLED:
+                if negative_cache != None:
+                    negative_cache.add_invalid (url)
+                print "Page not usable, trying again later"
+                outcome = pagestore.OUTCOME_INVALID
+                break
+            n_fail = n_fail + 1
+            print "Failure #: " + str (n_fail)
+            rates.overload (host)
+            breaker.failure (host)
+        except urllib2.URLError, e:
+            if writer != None:
+                writer.discard ()
+            n_fail = n_fail + 1
+            print "Failure #: " + str (n_fail)
+            print "URL Error:",e.reason , url
+            if is_overload (e):
+                rates.overload (host)
+            breaker.failure (host)
+        except Exception,e:
+            if writer != None:
+                writer.discard ()
+            n_fail = n_fail + 1
+            print "Failure #: " + str (n_fail)
+            print str(e)
+            if is_overload (e):
+                rates.overload (host)
+            breaker.failure (host)
+    if n_fail > n_fail_max:
+        print "Download failed, giving up"
+        outcome = pagestore.OUTCOME_FAILED
+    if journal != None and outcome != None:
+        journal.record (url, outcome)
+    if file_age <= file_age_max_hours and file_size > 0:
+        print "Local file is new enough - skipping download"
+    return contents
+
+# This defines the class SingleFlight.
+# It makes sure that each page (URL and local file) is fetched at most once in a run.
+# The first request for a page leads: it does the fetch.  A request made while that fetch is in flight waits for it
+# and gets the same contents; a request made after it finished is answered at once with None (the local file is
+# already up to date).  Either way, the duplicate fetch is saved and counted.
+class SingleFlight:
+    def __init__ (self):
+        self.lock = threading.Lock ()
+        self.dict_flights = {} # (URL, local file) -> Flight while in flight, FLIGHT_DONE once finished
+        self.n_waited = 0
+        self.n_done = 0
+        self.n_other_script = 0 # Pages another script was downloading (see download_page_shared)
+
+    # Purpose: join the flight for a page, starting it if there is none
+    # Inputs: string (URL), string (local file)
+    # Output: (Flight, True if the caller leads and must fetch the page), or (None, False) if already finished
+    def join (self, url, file_name):
+        key = (url, file_name)
+        with self.lock:
+            flight = self.dict_flights.get (key)
+            if flight == None:
+                flight = Flight ()
+                self.dict_flights [key] = flight
+                return (flight, True)
+            if flight == FLIGHT_DONE:
+                self.n_done = self.n_done + 1
+                return (None, False)
+            self.n_waited = self.n_waited + 1
+            return (flight, False)
+
+    # Purpose: end the flight for a page and pass its contents on to the requests waiting for it
+    # Inputs: string (URL), string (local file), Flight, contents (None if the page was not downloaded)
+    def finish (self, url, file_name, flight, contents):
+        with self.lock:
+            self.dict_flights [(url, file_name)] = FLIGHT_DONE # The contents are not kept beyond the flight
+        flight.contents = contents
+        flight.event.set ()
+
+    # Purpose: count a page that another script was downloading at the same time
+    def other_script (self):
+        with self.lock:
+            self.n_other_script = self.n_other_script + 1
+
+    # Purpose: report the duplicate fetches saved
+    # Output: string
+    def stats (self):
+        with self.lock:
+            n_saved = self.n_waited + self.n_done + self.n_other_script
+            return "Duplicate fetches saved: " + str(n_saved) + " (" + str(self.n_waited) + " joined a fetch in flight, " + str(self.n_done) + " after it finished, " + str(self.n_other_script) + " waited for another script)"
+
+# This defines the class Flight, one fetch in progress (see SingleFlight).
+class Flight:
+    def __init__ (self):
+        self.event = threading.Event ()
+        self.contents = None
+
+FLIGHT_DONE = 'done'
+
+flights = SingleFlight ()
+
+# Download a page from a url and save it, unless the same page is already being fetched or was fetched in this run
+# Inputs and output: as for fetch_page
+def download_page (url, file_name, file_age_max_hours, page_format = pagestore.FORMAT_PLAIN, journal = None, negative_cache = None, validator = None):
+    flight, is_leader = flights.join (url, file_name)
+    if flight == None:
+        print "Already fetched in this run - skipping download"
+        return None
+    if not is_leader:
+        print "Already being fetched - waiting for it"
+        flight.event.wait ()
+        return flight.contents
+    contents = None
+    try:
+        contents = fetch_page (url, file_name, file_age_max_hours, page_format, journal, negative_cache, validator)
+    finally:
+        flights.finish (url, file_name, flight, contents)
+    return contents
+
+# Lock files of download_page_shared, all in one directory beside the scripts
+DIR_LOCKS = os.path.join (os.path.dirname (os.path.abspath (__file__)), 'locks')
+
+# Purpose: get the lock file of a page (see download_page_shared)
+# The name is the full path of the page with '/' replaced by '_', so pages in different directories never share one.
+# Input: string (local file)
+# Output: string (path of the lock file)
+def lock_file_name (file_name):
+    return os.path.join (DIR_LOCKS, os.path.abspath (file_name).strip (os.sep).replace (os.sep, '_') + '.lock')
+
+# Purpose: download a page that other scripts may be downloading at the same time
+# An exclusive lock on the page's file in DIR_LOCKS (see lock_file_name) is held during the download, so a script
+# that wants the same page waits for the other one to finish and then finds the local file new enough (the exchange
+# lists are fetched by both screen.py and stock.py).  The lock files stay in DIR_LOCKS: removing one while another
+# script waits on it would let a third script lock a new file of the same name.
+# Inputs and output: as for download_page
+def download_page_shared (url, file_name, file_age_max_hours, page_format = pagestore.FORMAT_PLAIN, validator = None):
+    if not os.path.exists (DIR_LOCKS):
+        try:
+            os.makedirs (DIR_LOCKS)
+        except OSError:
+            pass # Created by another script in the meantime
+    with open (lock_file_name (file_name), 'a') as lock_file:
+        try:
+            fcntl.flock (lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            print "Another script is downloading this page - waiting for it"
+            fcntl.flock (lock_file, fcntl.LOCK_EX)
+            flights.other_script ()
+        try:
+            return download_page (url, file_name, file_age_max_hours, page_format, validator = validator)
+        finally:
+            fcntl.flock (lock_file, fcntl.LOCK_UN)
+
+# Purpose: get the host name of a URL
+# Input: string (URL)
+# Output: string (host name in lower case)
+def url_host (url):
+    return urlparse.urlparse (url).netloc.lower ()
+
+# Purpose: get a percentile of a list of numbers
+# Inputs: list of numbers sorted in increasing order (not empty), fraction (.99 for the 99th percentile)
+# Output: number
+def percentile (list_sorted, fraction):
+    return list_sorted [int (round (fraction * (len (list_sorted) - 1)))]
+
+# This defines the class Downloader (n_threads, n_per_host, dict_per_host).
+# It downloads pages on several threads at once.
+# n_threads: maximum number of requests in flight (all hosts combined)
+# n_per_host: maximum number of requests in flight for each host not listed in dict_per_host
+# dict_per_host: maximum number of requests in flight for specific hosts, e.g. {'finance.yahoo.com': 2}
+# queue_done: optional Queue.Queue that receives (group key, dict of local file -> contents) for each finished group
+# page_format: format in which the pages are saved (see pagestore.py)
+# journal: optional pagestore.Journal used to resume an interrupted run
+# negative_cache: optional pagestore.NegativeCache of pages known not to exist
+# Pages are added in groups (one group per stock).  The freshness rule of download_page applies to each page.
+# The contents are None for pages that were not downloaded in this run; these are read from the local file.
+class Downloader:
+    def __init__ (self, n_threads, n_per_host, dict_per_host = None, queue_done = None, page_format = pagestore.FORMAT_PLAIN, journal = None, negative_cache = None, deadline = None, validator = None):
+        self.n_threads = n_threads
+        self.n_per_host = n_per_host
+        self.dict_per_host = dict_per_host or {}
+        self.queue_done = queue_done
+        self.page_format = page_format
+        self.journal = journal
+        self.negative_cache = negative_cache
+        self.queue_jobs = Queue.PriorityQueue ()
+        self.n_jobs_queued = 0 # Keeps jobs with the same priority in the order they were added
+        self.lock = threading.Lock ()
+        self.dict_sem = {} # Host -> semaphore limiting the requests in flight for that host
+        self.dict_remain = {} # Group key -> number of pages not yet finished
+        self.dict_pages = {} # Group key -> dict of local file -> contents
+        self.list_threads = []
+        self.n_groups = 0
+        self.n_groups_done = 0
+        self.start_time = None
+        self.validator = validator
+        self.deadline = deadline # Time (in seconds since the epoch) after which no new downloads are started
+        self.list_skipped = [] # Group keys with pages skipped because of the deadline
+        self.list_seconds = [] # Time taken by each page, including waits and retries
+
+    # Purpose: get the semaphore that limits the number of requests in flight for a host
+    # Input: string (host name)
+    # Output: threading.BoundedSemaphore
+    def semaphore (self, host):
+        with self.lock:
+            if not (host in self.dict_sem):
+                n_max = self.dict_per_host.get (host, self.n_per_host)
+                self.dict_sem [host] = threading.BoundedSemaphore (n_max)
+            return self.dict_sem [host]
+
+    # Purpose: put an item on the job queue
+    # Jobs are taken in order of priority (lowest first), and in the order they were added within the same priority.
+    # Stop signals always come after every job.
+    # Inputs: priority (any value that can be compared), group key (None for the stop signal),
+    # job (None for a group without pages)
+    def put_job (self, priority, key, job):
+        with self.lock:
+            self.n_jobs_queued = self.n_jobs_queued + 1
+            n_seq = self.n_jobs_queued
+        if key == None:
+            self.queue_jobs.put ((1, None, n_seq, None, None))
+        else:
+            self.queue_jobs.put ((0, priority, n_seq, key, job))
+
+    # Purpose: add a group of pages to download
+    # A group without pages is still passed on to the next stage, in its turn.
+    # Inputs: group key (stock symbol), list of (URL, local file, maximum age in hours),
+    # priority (groups with lower values are downloaded first)
+    def add (self, key, list_jobs, priority = 0):
+        with self.lock:
+            self.dict_remain [key] = len (list_jobs)
+            self.dict_pages [key] = {}
+            self.n_groups = self.n_groups + 1
+        if pacer != None:
+            pacer.add (len (list_jobs))
+        if list_jobs == []:
+            self.put_job (priority, key, None)
+        for job in list_jobs:
+            self.put_job (priority, key, job)
+
+    # Purpose: start the worker threads
+    def start (self):
+        self.start_time = time.time ()
+        n = 0
+        while n < self.n_threads:
+            thread1 = threading.Thread (target = self.worker)
+            thread1.daemon = True
+            thread1.start ()
+            self.list_threads.append (thread1)
+            n = n + 1
+
+    # Purpose: wait until all pages added have been processed, then stop the worker threads
+    def join (self):
+        for thread1 in self.list_threads:
+            self.put_job (None, None, None)
+        for thread1 in self.list_threads:
+            # A timeout keeps the main thread responsive to Ctrl-C
+            while thread1.is_alive ():
+                thread1.join (1)
+        self.list_threads = []
+
+    # Purpose: download all pages added so far
+    def run (self):
+        self.start ()
+        self.join ()
+
+    # Purpose: tell whether the deadline has been reached
+    # Output: boolean
+    def past_deadline (self):
+        return self.deadline != None and time.time () >= self.deadline
+
+    # Purpose: download pages until the stop signal is received
+    # Once the deadline is reached, the remaining pages are skipped but their groups are still passed on,
+    # so the next stage works from the copies already saved.
+    def worker (self):
+        while True:
+            is_stop, priority, n_seq, key, job = self.queue_jobs.get ()
+            if is_stop:
+                break
+            if job == None: # Group without pages
+                with self.lock:
+                    dict_pages = self.dict_pages.pop (key)
+                    del self.dict_remain [key]
+                    self.n_groups_done = self.n_groups_done + 1
+                self.group_done (key, dict_pages)
+                continue
+            url, file_name, file_age_max_hours = job
+            contents = None
+            if self.past_deadline ():
+                with self.lock:
+                    if not (key in self.list_skipped):
+                        if self.list_skipped == []:
+                            print "Deadline reached, no new downloads are started"
+                        self.list_skipped.append (key)
+            else:
+                sem = self.semaphore (url_host (url))
+                sem.acquire ()
+                t_start = time.time ()
+                try:
+                    contents = download_page (url, file_name, file_age_max_hours, self.page_format, self.journal, self.negative_cache, self.validator)
+                except Exception, e:
+                    print "Download error:", str(e), url
+                finally:
+                    sem.release ()
+                with self.lock:
+                    self.list_seconds.append (time.time () - t_start)
+            if pacer != None:
+                pacer.finished ()
+            with self.lock:
+                self.dict_pages [key][file_name] = contents
+                self.dict_remain [key] = self.dict_remain [key] - 1
+                group_done = (self.dict_remain [key] == 0)
+                if group_done:
+                    dict_pages = self.dict_pages.pop (key)
+                    del self.dict_remain [key]
+                    self.n_groups_done = self.n_groups_done + 1
+            if group_done:
+                self.group_done (key, dict_pages)
+
+    # Purpose: summarize how long the pages took (only those for which download_page was called)
+    # Output: string
+    def latency_stats (self):
+        with self.lock:
+            list_seconds = sorted (self.list_seconds)
+        if list_seconds == []:
+            return "Page times: no pages"
+        list_parts = []
+        for name, fraction in [('median', .5), ('90%', .9), ('99%', .99), ('max', 1)]:
+            list_parts.append (name + " " + '{0:.2f}'.format (percentile (list_seconds, fraction)) + " s")
+        return "Page times (" + str(len (list_seconds)) + " pages, including waits and retries): " + ", ".join (list_parts)
+
+    # Purpose: pass a finished group on to the next stage and report progress
+    # The put blocks while the queue is full, so downloading never runs too far ahead of the next stage.
+    # Inputs: group key (stock symbol), dict of local file -> contents
+    def group_done (self, key, dict_pages):
+        if self.queue_done != None:
+            self.queue_done.put ((key, dict_pages))
+        t_elapsed = time.time () - self.start_time
+        try:
+            rate_s = self.n_groups_done / t_elapsed # Groups/second
+            remain_s = (self.n_groups - self.n_groups_done)/rate_s
+            remain_m = int (round(remain_s/60))
+            print "Download completion: " + str(self.n_groups_done) + '/' + str(self.n_groups) + "; Minutes remaining: " + str(remain_m)
+        except:
+            pass
+
+# DOWNLOAD STAGE
+# The settings and the set-up of the download stage of screen.py (PART 6), in one place so that loadtest.py runs
+# the same machinery as production.
+# Limits on the number of requests in flight
+# The downloads run on N_THREADS threads, and no host gets more than its own limit.
+N_THREADS = 8
+N_PER_HOST = 4 # Default limit for each host
+DICT_PER_HOST = {
+    'www.smartmoney.com': 4,
+    'finance.yahoo.com': 4,
+}
+
+# Format of the pages saved
+# pagestore.FORMAT_GZIP keeps the cache small; pagestore.FORMAT_PLAIN is easier to inspect when debugging.
+# Pages saved in either format are read correctly after the format is changed.
+PAGE_FORMAT = pagestore.FORMAT_GZIP
+
+# Pages that do not exist upstream (delisted symbols, preferred shares, odd tickers) are not requested again
+# for HOURS_MISSING_TTL hours.  Besides "404 Not Found" and empty pages, a page containing one of these
+# messages counts as missing.
+HOURS_MISSING_TTL = 24 * 14
+LIST_NOT_FOUND_MARKERS = [
+    'Symbol not found', # Smartmoney
+    'There are no All Markets results for', # Yahoo Finance symbol lookup
+]
+# A page rejected by the page check (a login wall, an empty template; see PAGE VALIDATION) is only held back for
+# HOURS_INVALID_RETRY hours, so it is tried again the next night.
+HOURS_INVALID_RETRY = 12
+
+# Files of the journal, of the negative cache and of the request rates, in the cache directory
+FILE_JOURNAL = 'journal.txt'
+FILE_MISSING = 'missing.json'
+FILE_RATES = 'rates.json'
+
+# Purpose: set up the download stage: the journal (except in offline mode), the negative cache and the Downloader
+# If the previous run was interrupted, its journal is used to skip the pages it already finished.
+# The request rates learned by the previous run are loaded too (see RateController).
+# Inputs: cache directory, Queue.Queue for the finished groups (or None), validator, time at which downloading must
+# stop (or None), maximum age of the journal records in hours, limits for specific hosts (DICT_PER_HOST if None)
+# Output: (Downloader, pagestore.Journal or None, pagestore.NegativeCache)
+def download_stage (dir_base, queue_done, validator, deadline, hours_journal, dict_per_host = None):
+    if dict_per_host == None:
+        dict_per_host = DICT_PER_HOST
+    journal = None
+    if not (offline):
+        journal = pagestore.Journal (os.path.join (dir_base, FILE_JOURNAL), hours_journal)
+        n_finished = journal.open ()
+        if n_finished > 0:
+            print "Resuming an interrupted run: " + str(n_finished) + " pages already finished"
+    negative_cache = pagestore.NegativeCache (os.path.join (dir_base, FILE_MISSING), HOURS_MISSING_TTL, LIST_NOT_FOUND_MARKERS, HOURS_INVALID_RETRY)
+    negative_cache.load ()
+    rates.load (os.path.join (dir_base, FILE_RATES))
+    downloader = Downloader (N_THREADS, N_PER_HOST, dict_per_host, queue_done, PAGE_FORMAT, journal, negative_cache, deadline, validator)
+    return (downloader, journal, negative_cache)
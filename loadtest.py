@@ -0,0 +1,571 @@
+#! /usr/bin/python
+
+# This script load-tests the download layer (fetch.py) without touching the real web sites.
+# It starts a local stand-in server for each upstream site (Smartmoney, Yahoo Finance, NASDAQ), each on a port of its
+# own so that the per-host limits and request rates apply to each site as they do in production, and runs the
+# download stage of screen.py (PART 6) against them: the exchange lists first, then every statement page of every
+# stock, on a Downloader set up by fetch.download_stage as in production (threads, per-host limits, page format,
+# journal, negative cache).  --window spreads the requests over a number of minutes, as screen.py --window does.
+# The funnel of PART 6 is not applied, so this is the worst case.
+#
+# The servers answer with synthetic pages shaped like the real ones (units marker, tables of figures, exchange list
+# columns), or with recorded pages: --companylist serves a saved exchange list, and --recorded serves the statement
+# pages saved in a screen-downloads directory (synthetic pages are used for the stocks that have none).
+# Like the real sites, they compress the pages for clients that accept it (--encoding: gzip, deflate, raw-deflate for
+# servers that send deflate data without the zlib wrapper, or none).
+#
+# FAULTS
+# Each request is delayed by a latency drawn from a distribution (--latency):
+#   fixed:SECONDS, uniform:LOW:HIGH, lognormal:MEDIAN:SIGMA, or pareto:MINIMUM:ALPHA (heavy tail)
+# and a share of the requests gets one of these faults instead of a normal answer:
+#   --error-rate: "429 Too Many Requests" or "503 Service Unavailable" (half each), with a Retry-After header
+#   (--retry-after)
+#   --truncate-rate: the body is cut off halfway and the connection closed (the Content-Length is still the full one)
+#   --hang-rate: no answer at all for --seconds-hang seconds (longer than the 10-second timeout of fetch.py),
+#   then the connection is closed
+#
+# REPORT
+# requests/second (as counted by the servers), pages/second, the time taken by each page including waits and retries
+# (median, 90%, 99%, max), the retries, the faults injected, the state of the shared download machinery
+# (circuit breaker, request rates, connection pool), and the bytes received from each site, compressed and decoded.
+#
+# Usage:
+# python loadtest.py [--stocks N] [--latency SPEC] [--error-rate P] [--truncate-rate P] [--hang-rate P] [--window MINUTES] ...
+# python loadtest.py --serve  (only run the servers, for pointing screen.py at them by hand)
+# python loadtest.py --help
+
+import sys
+import os
+import csv
+import time
+import random
+import math
+import shutil
+import tempfile
+import threading
+import argparse
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import gzip
+import zlib
+import StringIO
+
+import fetch
+import pagestore
+import pages
+
+LIST_EXCHANGES = ['nasdaq', 'nyse', 'amex']
+
+# Statement pages of a stock: (local page name, site, path and query with %s for the symbol)
+LIST_PAGES = [
+    ('balancesheet.html', 'smartmoney', '/quote/%s/?story=financials&timewindow=1&opt=YB&isFinprint=1&framework.view=smi_emptyView'),
+    ('income.html', 'smartmoney', '/quote/%s/?story=financials&timewindow=1&opt=YI&isFinprint=1&framework.view=smi_emptyView'),
+    ('cashflow.html', 'smartmoney', '/quote/%s/?story=financials&timewindow=1&opt=YC&isFinprint=1&framework.view=smi_emptyView'),
+    ('balancesheet-yahoo.html', 'yahoo', '/q/bs?s=%s&annual'),
+    ('income-yahoo.html', 'yahoo', '/q/is?s=%s+Income+Statement&annual'),
+]
+LIST_SITES = ['smartmoney', 'yahoo', 'nasdaq'] # In the order of their ports
+# Host of each site in production, for its limit in fetch.DICT_PER_HOST
+DICT_SITE_HOSTS = {
+    'smartmoney': 'www.smartmoney.com',
+    'yahoo': 'finance.yahoo.com',
+    'nasdaq': 'www.nasdaq.com',
+}
+
+# Rows of the synthetic pages: Smartmoney option -> row titles (as parsed by PART 7 of screen.py)
+DICT_ROWS_SMARTMONEY = {
+    'YB': ['Cash & Short Term Investments', 'Property, Plant & Equipment - Gross', 'Total Liabilities', 'Preferred Stock (Carrying Value)', 'Total Assets'],
+    'YI': ['Sales/Revenue', 'Income Tax'],
+    'YC': ['Net Operating Cash Flow'],
+}
+DICT_ROWS_YAHOO = {
+    'bs': ['Total Assets'],
+    'is': ['Total Revenue'],
+}
+N_YEARS = 5
+
+############
+# THE PAGES
+############
+
+# Purpose: get the synthetic symbol of a stock
+# Input: integer
+# Output: string (4 capital letters)
+def symbol_synthetic (n):
+    str_output = ''
+    i = 0
+    while i < 4:
+        str_output = chr (ord ('A') + n % 26) + str_output
+        n = n / 26
+        i = i + 1
+    return str_output
+
+# Purpose: get a random number generator that gives the same figures for a stock every time
+# Input: stock symbol
+# Output: random.Random
+def random_stock (symbol):
+    return random.Random (symbol)
+
+# Words of the filler that pads the synthetic pages
+LIST_FILLER_WORDS = ['market', 'shares', 'quarter', 'earnings', 'outlook', 'analyst', 'dividend', 'report', 'growth', 'sales']
+
+# Purpose: pad a page to about the size of a real one
+# The filler is markup with varied links and text, so the page compresses about as well as a real one.
+# Inputs: string (page), number of kilobytes
+# Output: string
+def padded (page, n_kb):
+    rng = random.Random (len (page))
+    list_lines = []
+    n_pad = n_kb * 1024 - len (page)
+    while n_pad > 0:
+        list_words = []
+        for n in range (rng.randint (3, 8)):
+            list_words.append (rng.choice (LIST_FILLER_WORDS))
+        line = '<div class="nav-item"><a href="/news/' + str(rng.randint (100000, 999999)) + '">' + ' '.join (list_words).capitalize () + '</a></div>'
+        list_lines.append (line)
+        n_pad = n_pad - len (line) - 1
+    return page.replace ('</body>', '\n'.join (list_lines) + '\n</body>')
+
+# Purpose: make a synthetic Smartmoney statement page
+# Inputs: stock symbol, option (YB, YI or YC), number of kilobytes
+# Output: string
+def page_smartmoney (symbol, opt, n_kb):
+    rng = random_stock (symbol + opt)
+    list_lines = ['<html><body>', '<p>Figures in millions of U.S. Dollars</p>', '<table>']
+    list_headings = []
+    year = 2012
+    while year > 2012 - N_YEARS:
+        list_headings.append ('<th>12/31/' + str(year) + '</th>')
+        year = year - 1
+    list_lines.append ('<tr><th></th>' + ''.join (list_headings) + '</tr>')
+    for title in DICT_ROWS_SMARTMONEY.get (opt, []):
+        list_cells = []
+        value = rng.uniform (100, 10000)
+        for n in range (N_YEARS):
+            list_cells.append ('<td>' + '{0:,.0f}'.format (value) + '</td>')
+            value = value / rng.uniform (1.0, 1.2)
+        list_lines.append ('<tr><th><div>' + title + '</div></th>' + ''.join (list_cells) + '</tr>')
+    list_lines.append ('</table>')
+    list_lines.append ('</body></html>')
+    return padded ('\n'.join (list_lines) + '\n', n_kb)
+
+# Purpose: make a synthetic Yahoo Finance statement page
+# Inputs: stock symbol, kind (bs or is), number of kilobytes
+# Output: string
+def page_yahoo (symbol, kind, n_kb):
+    rng = random_stock (symbol + kind)
+    list_lines = ['<html><body>', '<p>All numbers in thousands</p>', '<table>']
+    for title in DICT_ROWS_YAHOO.get (kind, []):
+        list_cells = []
+        value = rng.uniform (1E5, 1E7)
+        for n in range (N_YEARS - 2):
+            list_cells.append ('<td><strong>' + '{0:,.0f}'.format (value) + '</strong></td>')
+            value = value / rng.uniform (1.0, 1.2)
+        list_lines.append ('<tr><td><strong>' + title + '</strong></td>' + ''.join (list_cells) + '</tr>')
+    list_lines.append ('</table>')
+    list_lines.append ('</body></html>')
+    return padded ('\n'.join (list_lines) + '\n', n_kb)
+
+# Purpose: make a synthetic exchange list
+# Inputs: position of the exchange in LIST_EXCHANGES, number of stocks
+# Output: string (CSV)
+def page_exchange_list (i_exchange, n_stocks):
+    list_lines = ['"Symbol","Name","LastSale","MarketCap","ADR TSO","IPOyear","Sector","Industry","Summary Quote",']
+    n = 0
+    while n < n_stocks:
+        symbol = symbol_synthetic (i_exchange * n_stocks + n)
+        rng = random_stock (symbol)
+        price = rng.uniform (1, 100)
+        list_lines.append ('"' + symbol + '","' + symbol + ' Corporation","' + '{0:.2f}'.format (price) + '","' + '{0:.0f}'.format (price * rng.uniform (1E6, 1E9)) + '","n/a","n/a","Technology","Industrial Machinery/Components","http://www.nasdaq.com/symbol/' + symbol.lower () + '",')
+        n = n + 1
+    return '\n'.join (list_lines) + '\n'
+
+# Purpose: split a saved exchange list into one list per exchange (round robin)
+# Input: file name (CSV with a Symbol column, such as screen-input/companylist-test.csv)
+# Output: list of strings (CSV), one for each exchange in LIST_EXCHANGES
+def split_companylist (file_name):
+    with open (file_name, 'r') as f:
+        list_lines = f.read ().splitlines ()
+    list_output = []
+    i_exchange = 0
+    while i_exchange < len (LIST_EXCHANGES):
+        list_body = list_lines [1 + i_exchange::len (LIST_EXCHANGES)]
+        list_output.append ('\n'.join ([list_lines [0]] + list_body) + '\n')
+        i_exchange = i_exchange + 1
+    return list_output
+
+#############
+# THE FAULTS
+#############
+
+# Purpose: make a function that draws latencies from a distribution
+# Input: string (fixed:SECONDS, uniform:LOW:HIGH, lognormal:MEDIAN:SIGMA, or pareto:MINIMUM:ALPHA)
+# Output: function (random.Random) -> number of seconds
+def latency_sampler (spec):
+    list_parts = spec.split (':')
+    name = list_parts [0]
+    list_params = [float (x) for x in list_parts [1:]]
+    if name == 'fixed' and len (list_params) == 1:
+        return lambda rng: list_params [0]
+    if name == 'uniform' and len (list_params) == 2:
+        return lambda rng: rng.uniform (list_params [0], list_params [1])
+    if name == 'lognormal' and len (list_params) == 2:
+        return lambda rng: rng.lognormvariate (math.log (list_params [0]), list_params [1])
+    if name == 'pareto' and len (list_params) == 2:
+        return lambda rng: list_params [0] * rng.paretovariate (list_params [1])
+    raise ValueError ("Unknown latency distribution: " + spec)
+
+# This defines the class Faults (latency, error_rate, truncate_rate, hang_rate, seconds_retry_after, seconds_hang, seed).
+# It decides what happens to each request, and counts the outcomes.
+class Faults:
+    def __init__ (self, latency, error_rate, truncate_rate, hang_rate, seconds_retry_after, seconds_hang, seed):
+        self.latency = latency_sampler (latency)
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.hang_rate = hang_rate
+        self.seconds_retry_after = seconds_retry_after
+        self.seconds_hang = seconds_hang
+        self.rng = random.Random (seed)
+        self.lock = threading.Lock ()
+        self.dict_n = {} # (site, outcome) -> number of requests
+        self.set_paths = set () # (site, path) of every request, to count the pages requested more than once
+
+    # Purpose: decide what happens to a request
+    # Inputs: site, path of the request
+    # Output: (outcome: 'ok', '429', '503', 'truncate' or 'hang', seconds of latency)
+    def choose (self, site, path):
+        with self.lock:
+            x = self.rng.random ()
+            seconds = max (0, self.latency (self.rng))
+            if x < self.error_rate / 2:
+                outcome = '429'
+            elif x < self.error_rate:
+                outcome = '503'
+            elif x < self.error_rate + self.truncate_rate:
+                outcome = 'truncate'
+            elif x < self.error_rate + self.truncate_rate + self.hang_rate:
+                outcome = 'hang'
+            else:
+                outcome = 'ok'
+            self.dict_n [(site, outcome)] = self.dict_n.get ((site, outcome), 0) + 1
+            self.set_paths.add ((site, path))
+            return outcome, seconds
+
+    # Purpose: count the requests received
+    # Output: (number of requests, number of different pages requested)
+    def n_requests (self):
+        with self.lock:
+            return sum (self.dict_n.values ()), len (self.set_paths)
+
+    # Purpose: report the outcomes of the requests
+    # Output: string
+    def stats (self):
+        with self.lock:
+            list_parts = []
+            for site in LIST_SITES:
+                list_outcomes = []
+                for outcome in ['ok', '429', '503', 'truncate', 'hang']:
+                    n = self.dict_n.get ((site, outcome), 0)
+                    if n > 0:
+                        list_outcomes.append (outcome + " " + str(n))
+                if list_outcomes != []:
+                    list_parts.append (site + ": " + ", ".join (list_outcomes))
+        return "Server answers: " + "; ".join (list_parts)
+
+##############
+# THE SERVERS
+##############
+
+# This defines the request handler of the stand-in servers.
+# The server it belongs to has the attributes site, faults, n_kb, encoding, list_exchange_lists, and dir_recorded.
+class StandInHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, as the real sites
+
+    def log_message (self, format, *args):
+        pass
+
+    # Purpose: get the page for a request
+    # Output: string (None if there is no such page)
+    def page (self):
+        parts = urlparse.urlsplit (self.path)
+        dict_query = urlparse.parse_qs (parts.query)
+        list_path = parts.path.strip ('/').split ('/')
+        site = self.server.site
+        if site == 'nasdaq':
+            exchange = dict_query.get ('exchange', [''])[0].lower ()
+            if not (exchange in LIST_EXCHANGES):
+                return None
+            return self.server.list_exchange_lists [LIST_EXCHANGES.index (exchange)]
+        if site == 'smartmoney' and len (list_path) >= 2 and list_path [0] == 'quote':
+            symbol = list_path [1]
+            opt = dict_query.get ('opt', [''])[0]
+            name = {'YB': 'balancesheet.html', 'YI': 'income.html', 'YC': 'cashflow.html'}.get (opt)
+            return self.recorded (symbol, name) or page_smartmoney (symbol, opt, self.server.n_kb)
+        if site == 'yahoo' and len (list_path) == 2 and list_path [0] == 'q':
+            kind = list_path [1]
+            symbol = dict_query.get ('s', [''])[0].split (' ') [0]
+            name = {'bs': 'balancesheet-yahoo.html', 'is': 'income-yahoo.html'}.get (kind)
+            return self.recorded (symbol, name) or page_yahoo (symbol, kind, self.server.n_kb)
+        return None
+
+    # Purpose: compress a page as the server is set up to, if the client accepts it
+    # Input: string
+    # Output: (string, Content-Encoding or None)
+    def encoded (self, body):
+        encoding = self.server.encoding
+        list_accepted = [x.split (';') [0].strip () for x in (self.headers.getheader ('Accept-Encoding') or '').split (',')]
+        if encoding == 'gzip' and 'gzip' in list_accepted:
+            buf = StringIO.StringIO ()
+            f = gzip.GzipFile (fileobj = buf, mode = 'wb')
+            f.write (body)
+            f.close ()
+            return buf.getvalue (), 'gzip'
+        if encoding == 'deflate' and 'deflate' in list_accepted:
+            return zlib.compress (body), 'deflate'
+        if encoding == 'raw-deflate' and 'deflate' in list_accepted:
+            obj = zlib.compressobj (zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+            return obj.compress (body) + obj.flush (), 'deflate'
+        return body, None
+
+    # Purpose: get a recorded page
+    # Inputs: stock symbol, local page name
+    # Output: string (None if there is no recorded page)
+    def recorded (self, symbol, name):
+        if self.server.dir_recorded == None or name == None:
+            return None
+        file_name = os.path.join (self.server.dir_recorded, symbol, name)
+        if not pagestore.page_exists (file_name):
+            return None
+        return pagestore.read_page (file_name)
+
+    def do_GET (self):
+        faults = self.server.faults
+        outcome, seconds = faults.choose (self.server.site, self.path)
+        time.sleep (seconds)
+        if outcome == 'hang':
+            self.server.event_stop.wait (faults.seconds_hang)
+            self.close_connection = 1
+            return
+        if outcome == '429' or outcome == '503':
+            self.send_response (int (outcome))
+            self.send_header ('Retry-After', str(faults.seconds_retry_after))
+            self.send_header ('Content-Length', '0')
+            self.end_headers ()
+            return
+        body = self.page ()
+        if body == None:
+            self.send_response (404)
+            self.send_header ('Content-Length', '0')
+            self.end_headers ()
+            return
+        body, encoding = self.encoded (body)
+        self.send_response (200)
+        self.send_header ('Content-Type', 'text/html')
+        self.send_header ('Vary', 'Accept-Encoding')
+        if encoding != None:
+            self.send_header ('Content-Encoding', encoding)
+        self.send_header ('Content-Length', str(len (body)))
+        self.end_headers ()
+        if outcome == 'truncate':
+            self.wfile.write (body [:len (body) / 2])
+            self.close_connection = 1
+            return
+        self.wfile.write (body)
+
+# This defines the class StandInServer ((host, port), handler class).
+# Each connection is served on a thread of its own; stop waits for those threads, so none is left running.
+class StandInServer (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__ (self, address, handler):
+        BaseHTTPServer.HTTPServer.__init__ (self, address, handler)
+        self.event_stop = threading.Event () # Ends the hung requests early
+        self.list_threads = []
+        self.lock_threads = threading.Lock ()
+
+    def process_request (self, request, client_address):
+        thread1 = threading.Thread (target = self.process_request_thread, args = (request, client_address))
+        thread1.daemon = True
+        with self.lock_threads:
+            self.list_threads = [t for t in self.list_threads if t.is_alive ()]
+            self.list_threads.append (thread1)
+        thread1.start ()
+
+    # Clients hanging up (after a timeout, or at the end of the test) are expected, so they are not reported
+    def handle_error (self, request, client_address):
+        pass
+
+    # Purpose: stop serving and wait for the connections to finish
+    # The clients must have closed their idle connections first (see fetch.ConnectionPool.close_idle).
+    def stop (self):
+        self.event_stop.set ()
+        self.shutdown ()
+        self.server_close ()
+        with self.lock_threads:
+            list_threads = list (self.list_threads)
+        for thread1 in list_threads:
+            thread1.join ()
+
+# Purpose: start a stand-in server for each site, each on a thread of its own
+# Inputs: first port, Faults, number of kilobytes of each statement page, encoding (see --encoding),
+# list of exchange lists (CSV), directory of recorded pages (or None)
+# Output: dict of site -> (server, base URL)
+def start_servers (port, faults, n_kb, encoding, list_exchange_lists, dir_recorded):
+    dict_servers = {}
+    i_site = 0
+    while i_site < len (LIST_SITES):
+        site = LIST_SITES [i_site]
+        server = StandInServer (('127.0.0.1', port + i_site), StandInHandler)
+        server.site = site
+        server.faults = faults
+        server.n_kb = n_kb
+        server.encoding = encoding
+        server.list_exchange_lists = list_exchange_lists
+        server.dir_recorded = dir_recorded
+        thread1 = threading.Thread (target = server.serve_forever)
+        thread1.daemon = True
+        thread1.start ()
+        dict_servers [site] = (server, 'http://127.0.0.1:' + str(port + i_site))
+        i_site = i_site + 1
+    return dict_servers
+
+##############
+# THE HARNESS
+##############
+
+# Purpose: get the symbols in an exchange list
+# Input: local file
+# Output: list of stock symbols
+def symbols_exchange_list (file_name):
+    list_symbols = []
+    reader = csv.reader (pagestore.read_page (file_name).splitlines ())
+    list_titles = reader.next ()
+    n_symbol = list_titles.index ('Symbol')
+    for row in reader:
+        if len (row) > n_symbol and row [n_symbol] != '':
+            list_symbols.append (row [n_symbol])
+    return list_symbols
+
+# Purpose: get the per-host limits of production (fetch.DICT_PER_HOST) for the stand-in servers
+# Input: dict from start_servers
+# Output: dict of host -> maximum number of requests in flight
+def per_host_stand_in (dict_servers):
+    dict_per_host = {}
+    for site in LIST_SITES:
+        host = DICT_SITE_HOSTS [site]
+        if host in fetch.DICT_PER_HOST:
+            dict_per_host [fetch.url_host (dict_servers [site][1])] = fetch.DICT_PER_HOST [host]
+    return dict_per_host
+
+# Purpose: run the download stage against the stand-in servers
+# The Downloader, its journal and its negative cache are set up by fetch.download_stage, as in screen.py.
+# Inputs: dict from start_servers, directory for the downloads, True to show the output of the downloads
+# Output: (number of stocks, number of pages, number of pages missing at the end, Downloader, seconds taken)
+def run_downloads (dict_servers, dir_downloads, verbose):
+    stdout = sys.stdout
+    if not verbose:
+        sys.stdout = open (os.devnull, 'w')
+    try:
+        t_start = time.time ()
+        list_symbols = []
+        for exchange in LIST_EXCHANGES:
+            url = dict_servers ['nasdaq'][1] + '/screening/companies-by-industry.aspx?exchange=' + exchange + '&render=download'
+            file_name = os.path.join (dir_downloads, 'companylist-' + exchange + '.csv')
+            fetch.download_page (url, file_name, 0, validator = fetch.validate_exchange_list)
+            if pagestore.page_exists (file_name):
+                list_symbols = list_symbols + symbols_exchange_list (file_name)
+
+        downloader, journal, negative_cache = fetch.download_stage (dir_downloads, None, pages.validate_page, None, 0, per_host_stand_in (dict_servers))
+        list_files = []
+        for symbol in sorted (set (list_symbols)):
+            list_jobs = []
+            for name, site, path in LIST_PAGES:
+                file_name = os.path.join (dir_downloads, symbol, name)
+                list_jobs.append ((dict_servers [site][1] + path % symbol, file_name, 0))
+                list_files.append (file_name)
+            downloader.add (symbol, list_jobs)
+        downloader.run ()
+        journal.finish ()
+        seconds = time.time () - t_start
+    finally:
+        if not verbose:
+            sys.stdout.close ()
+            sys.stdout = stdout
+    n_missing = 0
+    for file_name in list_files:
+        if not pagestore.page_exists (file_name):
+            n_missing = n_missing + 1
+    return len (set (list_symbols)), len (list_files), n_missing, downloader, seconds
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser (description = 'Load test of the download layer against local stand-in servers')
+    parser.add_argument ('--stocks', type = int, default = 100, help = 'stocks in each synthetic exchange list (default 100)')
+    parser.add_argument ('--companylist', help = 'serve this saved exchange list (split between the exchanges) instead')
+    parser.add_argument ('--recorded', metavar = 'DIR', help = 'serve the statement pages saved in this screen-downloads directory')
+    parser.add_argument ('--page-kb', type = int, default = 60, help = 'size of each synthetic statement page (default 60 KB)')
+    parser.add_argument ('--encoding', default = 'gzip', choices = ['gzip', 'deflate', 'raw-deflate', 'none'], help = 'compression of the pages for clients that accept it (default gzip)')
+    parser.add_argument ('--latency', default = 'lognormal:0.05:0.8', help = 'latency of each request (default lognormal:0.05:0.8)')
+    parser.add_argument ('--error-rate', type = float, default = 0.02, help = 'share of requests answered with 429 or 503 (default 0.02)')
+    parser.add_argument ('--retry-after', type = int, default = 1, help = 'Retry-After of those answers, in seconds (default 1)')
+    parser.add_argument ('--truncate-rate', type = float, default = 0.01, help = 'share of requests with a truncated body (default 0.01)')
+    parser.add_argument ('--hang-rate', type = float, default = 0.0, help = 'share of requests that never get an answer (default 0)')
+    parser.add_argument ('--seconds-hang', type = float, default = 15, help = 'how long a hung request is held open (default 15)')
+    parser.add_argument ('--window', type = float, metavar = 'MINUTES', help = 'spread the requests over this many minutes, as screen.py --window does')
+    parser.add_argument ('--seed', type = int, default = 1, help = 'seed of the fault injection (default 1)')
+    parser.add_argument ('--port', type = int, default = 8780, help = 'port of the first server; the others use the next ones (default 8780)')
+    parser.add_argument ('--serve', action = 'store_true', help = 'only run the servers until interrupted')
+    parser.add_argument ('--keep', action = 'store_true', help = 'keep the downloaded pages')
+    parser.add_argument ('--verbose', action = 'store_true', help = 'show the output of the downloads')
+    args = parser.parse_args ()
+
+    faults = Faults (args.latency, args.error_rate, args.truncate_rate, args.hang_rate, args.retry_after, args.seconds_hang, args.seed)
+    if args.companylist != None:
+        list_exchange_lists = split_companylist (args.companylist)
+    else:
+        list_exchange_lists = []
+        for i_exchange in range (len (LIST_EXCHANGES)):
+            list_exchange_lists.append (page_exchange_list (i_exchange, args.stocks))
+    if args.recorded != None and os.path.exists (os.path.join (args.recorded, pagestore.FILE_STORE)):
+        pagestore.open_store (args.recorded)
+    dict_servers = start_servers (args.port, faults, args.page_kb, args.encoding, list_exchange_lists, args.recorded)
+    for site in LIST_SITES:
+        print "Stand-in for " + site + ": " + dict_servers [site][1]
+
+    if args.serve:
+        try:
+            while True:
+                time.sleep (1)
+        except KeyboardInterrupt:
+            pass
+        print faults.stats ()
+        sys.exit (0)
+
+    dir_downloads = tempfile.mkdtemp (prefix = 'loadtest-')
+    if args.window != None:
+        fetch.pace_until (time.time () + args.window * 60)
+    try:
+        n_stocks, n_pages, n_missing, downloader, seconds = run_downloads (dict_servers, dir_downloads, args.verbose)
+    finally:
+        fetch.pool.close_idle ()
+        for site in LIST_SITES:
+            dict_servers [site][0].stop ()
+        if args.keep:
+            print "Pages kept in " + dir_downloads
+        else:
+            shutil.rmtree (dir_downloads)
+
+    n_requests, n_paths = faults.n_requests ()
+    print "Stocks: " + str(n_stocks) + "; statement pages: " + str(n_pages) + " (" + str(n_missing) + " missing at the end)"
+    print "Time: " + '{0:.1f}'.format (seconds) + " s; requests: " + str(n_requests) + " (" + '{0:.1f}'.format (n_requests / seconds) + "/s), of which " + str(n_requests - n_paths) + " repeated; pages: " + '{0:.1f}'.format ((n_pages + len (LIST_EXCHANGES)) / seconds) + "/s"
+    print downloader.latency_stats ()
+    if fetch.pacer != None:
+        print fetch.pacer.stats ()
+    print fetch.retry_stats ()
+    print faults.stats ()
+    print fetch.invalid_stats ()
+    print fetch.breaker.stats ()
+    print fetch.rates.stats ()
+    print fetch.pool.stats ()
+    print fetch.transfer_stats ()
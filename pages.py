@@ -0,0 +1,40 @@
+#! /usr/bin/python
+
+# This module contains what the Doppler Value Investing scripts know about the statement pages of the upstream web
+# sites (Smartmoney, Yahoo Finance): the units they state and the check that a downloaded page is usable.
+# screen.py parses and validates its pages with these functions, and loadtest.py validates the pages of its
+# stand-in servers with the same check.
+
+# Purpose: Determine the units in the page (thousands of dollars or millions of dollars)
+# Input: string
+# Output: number
+def get_units (string_html):
+    str_thousands = "Figures in thousands of U.S. Dollars"
+    str_thousands_alt = "All numbers in thousands" # Yahoo
+    str_millions = "Figures in millions of U.S. Dollars"
+    str_millions_alt = "All numbers in millions" # Yahoo
+    str_billions = "Figures in billions of U.S. Dollars"
+    str_billions_alt = "All numbers in billions" # Yahoo
+    if (str_thousands in string_html) or (str_thousands_alt in string_html):
+        return 1E3
+    elif (str_millions in string_html) or (str_millions_alt in string_html):
+        return 1E6
+    elif (str_billions in string_html) or (str_billions_alt in string_html):
+        return 1E9
+    else:
+        return None
+
+# PAGE VALIDATION
+# Every statement page, from Smartmoney or Yahoo Finance, states its units ("Figures in millions of U.S. Dollars",
+# "All numbers in thousands"), which get_units relies on, and holds a table of figures.
+# A page without them (a throttling page, a login wall, an empty template) is not saved and the previous copy is
+# kept; only throttling pages are tried again (see PAGE VALIDATION in fetch.py).
+# Purpose: check a downloaded statement page (validator for fetch.download_page)
+# Inputs: local file, text of the page
+# Output: reason why the page is not valid (None if it is)
+def validate_page (file_name, text):
+    if get_units (text) == None:
+        return 'no units marker'
+    if not ('<td' in text.lower ()):
+        return 'no table of figures'
+    return None
@@ -0,0 +1,727 @@
+#! /usr/bin/python
+
+# This module stores the pages downloaded by the Doppler Value Investing scripts.
+# Pages are saved either as plain files or gzip-compressed (balancesheet.html -> balancesheet.html.gz).
+# Pages are always referred to by their plain name; read_page finds and decompresses the stored file.
+# Each downloaded page has a metadata file beside it (balancesheet.html -> balancesheet.html.meta).
+# The metadata are used to ask the upstream server whether the page has changed since it was downloaded.
+# The Journal records the outcome of each download so that an interrupted run can be resumed.
+# The NegativeCache remembers pages that do not exist upstream, so they are not requested again every run.
+# The pages of each stock are kept in a directory of their own (an entry), or all together in a SQLite database
+# (see PAGE DATABASE); the CACHE SIZE functions keep the number and total size of the entries within a budget by
+# removing the least recently used ones.
+#
+# Usage from the command line:
+# python pagestore.py stats DIRECTORY
+# python pagestore.py evict DIRECTORY MAX_MEGABYTES MAX_ENTRIES
+
+import os
+import time
+import json
+import hashlib
+import gzip
+import threading
+import tempfile
+import shutil
+import sys
+import sqlite3
+import StringIO
+
+FORMAT_PLAIN = 'plain' # Easy to inspect when debugging
+FORMAT_GZIP = 'gzip' # Several times smaller than plain files
+EXT_GZIP = '.gz'
+
+# Purpose: get the path of the file in which a page is actually stored
+# Input: string (plain name of the page)
+# Output: string (the compressed file if there is one, otherwise the plain name)
+def stored_file (file_name):
+    if os.path.exists (file_name + EXT_GZIP):
+        return file_name + EXT_GZIP
+    return file_name
+
+# Purpose: get the size of the stored file of a page
+# Input: string (plain name of the page)
+# Output: integer (bytes; 0 if the page does not exist)
+def page_size (file_name):
+    key = store_key (file_name)
+    if key != None:
+        return store.info (key) [1]
+    try:
+        return os.path.getsize (stored_file (file_name))
+    except:
+        return 0
+
+# Purpose: tell whether a page is stored
+# Input: string (plain name of the page)
+# Output: boolean
+def page_exists (file_name):
+    return store_key (file_name) != None or os.path.exists (stored_file (file_name))
+
+# Purpose: get the time when a page was last saved or confirmed to be current
+# Input: string (plain name of the page)
+# Output: time in seconds since the epoch (None if the page does not exist)
+def page_mtime (file_name):
+    key = store_key (file_name)
+    if key != None:
+        return store.info (key) [2]
+    try:
+        return os.path.getmtime (stored_file (file_name))
+    except OSError:
+        return None
+
+# This defines the class PageWriter (file_name, page_format).
+# It saves a page piece by piece as it arrives, so the whole page never has to be held in memory.
+# The pieces go to a temporary file in the same directory; commit then renames it to the page's stored file in one
+# step, so no reader ever sees a half-written page.  discard deletes the temporary file instead.
+# Saving a page in one format removes any copy stored in the other format.
+# An empty page is saved as an empty file in both formats, so that page_size reports 0 for it.
+# With the page database open (see PAGE DATABASE), commit moves the finished page into the database instead,
+# and removes any copy of it left as a loose file.
+class PageWriter:
+    def __init__ (self, file_name, page_format):
+        self.file_name = file_name
+        self.page_format = page_format
+        if page_format == FORMAT_GZIP:
+            self.path = file_name + EXT_GZIP
+            self.path_other = file_name
+        else:
+            self.path = file_name
+            self.path_other = file_name + EXT_GZIP
+        self.key = None
+        if store != None:
+            self.key = store.key (file_name)
+        if self.key != None:
+            dir_tmp = store.dir_base
+        else:
+            dir_tmp = os.path.dirname (self.path) or '.'
+            if not os.path.exists (dir_tmp):
+                os.makedirs (dir_tmp)
+        fd, self.path_tmp = tempfile.mkstemp (dir = dir_tmp, prefix = os.path.basename (self.path) + '.', suffix = '.tmp')
+        self.raw_file = os.fdopen (fd, 'wb')
+        self.local_file = None # Opened at the first piece, so that an empty page stays an empty file
+        self.sha1 = hashlib.sha1 ()
+        self.n_bytes = 0
+
+    # Purpose: add a piece of the page
+    # Input: string
+    def write (self, data):
+        if data == '':
+            return
+        if self.local_file == None:
+            if self.page_format == FORMAT_GZIP:
+                self.local_file = gzip.GzipFile (os.path.basename (self.file_name), 'wb', 9, self.raw_file)
+            else:
+                self.local_file = self.raw_file
+        self.local_file.write (data)
+        self.sha1.update (data)
+        self.n_bytes = self.n_bytes + len (data)
+
+    # Purpose: get the content hash of the page written so far
+    # Output: string (SHA-1 in hex)
+    def digest (self):
+        return self.sha1.hexdigest ()
+
+    def close_files (self):
+        if self.local_file != None and self.local_file != self.raw_file:
+            self.local_file.close ()
+        self.raw_file.close ()
+
+    # Purpose: put the finished page in place
+    def commit (self):
+        self.close_files ()
+        if self.key != None:
+            dict_meta = read_meta (self.file_name) # Kept from a loose copy, if any
+            with open (self.path_tmp, 'rb') as f:
+                store.put (self.key, self.page_format, f)
+            os.remove (self.path_tmp)
+            if dict_meta != {} and store.read_meta (self.key) == {}:
+                store.write_meta (self.key, dict_meta)
+            for path in [self.path, self.path_other, meta_file (self.file_name)]:
+                if os.path.exists (path):
+                    os.remove (path)
+            return
+        os.chmod (self.path_tmp, 0644)
+        os.rename (self.path_tmp, self.path)
+        if os.path.exists (self.path_other):
+            os.remove (self.path_other)
+
+    # Purpose: throw away an unfinished page, leaving any earlier copy in place
+    def discard (self):
+        self.close_files ()
+        try:
+            os.remove (self.path_tmp)
+        except OSError:
+            pass
+
+# Purpose: save a page in the given format, replacing any copy stored in the other format
+# Inputs: string (plain name of the page), string (contents), FORMAT_PLAIN or FORMAT_GZIP
+def write_page (file_name, contents, page_format):
+    writer = PageWriter (file_name, page_format)
+    writer.write (contents)
+    writer.commit ()
+
+# Purpose: read a page, decompressing it if necessary
+# Input: string (plain name of the page)
+# Output: string (raises IOError if the page does not exist)
+def read_page (file_name):
+    key = store_key (file_name)
+    if key != None:
+        page_format, data = store.data (key)
+        if page_format == FORMAT_GZIP and data != '':
+            return gzip.GzipFile (fileobj = StringIO.StringIO (data)).read ()
+        return data
+    path = stored_file (file_name)
+    if path.endswith (EXT_GZIP) and os.path.getsize (path) > 0:
+        local_file = gzip.open (path, 'rb')
+    else:
+        local_file = open (path, 'rb')
+    contents = local_file.read ()
+    local_file.close ()
+    return contents
+
+# Purpose: get the name of the metadata file for a downloaded page
+# Input: string (path of the downloaded page)
+# Output: string
+def meta_file (file_name):
+    return file_name + '.meta'
+
+# Purpose: get the content hash of a page
+# Input: string (contents of the page)
+# Output: string (SHA-1 in hex)
+def digest (contents):
+    return hashlib.sha1 (contents).hexdigest ()
+
+# Purpose: get the content hash of a stored page without reading it if possible
+# The hash recorded in the metadata is used when there is one and the stored file still has the recorded size.
+# Input: string (plain name of the page)
+# Output: string (SHA-1 in hex; None if the page does not exist)
+def page_digest (file_name):
+    if not page_exists (file_name):
+        return None
+    dict_meta = read_meta (file_name)
+    if dict_meta.get ('sha1') and dict_meta.get ('size') == page_size (file_name):
+        return dict_meta ['sha1']
+    try:
+        return digest (read_page (file_name))
+    except:
+        return None
+
+# Purpose: read the metadata of a downloaded page
+# Input: string (path of the downloaded page)
+# Output: dict with the keys url, etag, last_modified, fetched, checked, sha1 (empty if there are no metadata)
+# fetched: time (seconds since the epoch) when the page was last downloaded in full
+# checked: time when the page was last confirmed to be current (download or "304 Not Modified")
+def read_meta (file_name):
+    key = store_key (file_name)
+    if key != None:
+        return store.read_meta (key)
+    try:
+        with open (meta_file (file_name), 'r') as f:
+            return json.load (f)
+    except:
+        return {}
+
+# Purpose: save the metadata of a downloaded page
+# The metadata file is replaced in one step, so a crash never leaves it half-written.
+# Inputs: string (path of the downloaded page), dict
+def write_meta (file_name, dict_meta):
+    key = store_key (file_name)
+    if key != None:
+        store.write_meta (key, dict_meta)
+        return
+    file_tmp = meta_file (file_name) + '.tmp'
+    with open (file_tmp, 'w') as f:
+        json.dump (dict_meta, f)
+    os.rename (file_tmp, meta_file (file_name))
+
+# Purpose: get the headers for a conditional request
+# The headers are only used if the local copy still exists and came from the same URL.
+# Inputs: string (URL), string (path of the downloaded page)
+# Output: dict of HTTP headers (empty if a full download is needed)
+def conditional_headers (url, file_name):
+    dict_headers = {}
+    dict_meta = read_meta (file_name)
+    if page_size (file_name) == 0 or dict_meta.get ('url') != url:
+        return dict_headers
+    if dict_meta.get ('etag'):
+        dict_headers ['If-None-Match'] = dict_meta ['etag']
+    if dict_meta.get ('last_modified'):
+        dict_headers ['If-Modified-Since'] = dict_meta ['last_modified']
+    return dict_headers
+
+# Purpose: record a full download of a page
+# The size of the stored file is kept too, so that page_digest can tell whether the hash still matches the file.
+# Inputs: string (URL), string (path of the downloaded page), string (SHA-1 of the contents), HTTP response headers
+def record_download (url, file_name, sha1, headers):
+    now = time.time ()
+    dict_meta = {}
+    dict_meta ['url'] = url
+    dict_meta ['etag'] = headers.getheader ('ETag')
+    dict_meta ['last_modified'] = headers.getheader ('Last-Modified')
+    dict_meta ['fetched'] = now
+    dict_meta ['checked'] = now
+    dict_meta ['sha1'] = sha1
+    dict_meta ['size'] = page_size (file_name)
+    write_meta (file_name, dict_meta)
+
+# Purpose: record a "304 Not Modified" response for a page
+# The modification time of the local copy is reset, so that the page counts as new again (see page_mtime).
+# Input: string (path of the downloaded page)
+def record_not_modified (file_name):
+    dict_meta = read_meta (file_name)
+    dict_meta ['checked'] = time.time ()
+    write_meta (file_name, dict_meta)
+    key = store_key (file_name)
+    if key != None:
+        store.touch_page (key)
+    else:
+        os.utime (stored_file (file_name), None)
+
+# PAGE DATABASE
+# open_store keeps the pages under a cache directory in one SQLite database (DIRECTORY/pages.sqlite) instead of one
+# file per page, with the metadata of each page beside it.  A page is looked up by (entry, page): the name of the
+# directory it would be in and its file name, so the plain names used everywhere else keep working:
+# screen-downloads/KO/balancesheet.html -> ('KO', 'balancesheet.html').
+# Pages left as loose files from before the switch are still found, and move into the database when saved again.
+# The other files under the cache directory (journal, negative cache) stay loose files.
+# The data of a page is kept in rows of N_BYTES_CHUNK_STORE bytes (table chunks), written one at a time as the
+# finished page is read back from its temporary file, so saving a page never holds all of it in memory.
+FILE_STORE = 'pages.sqlite'
+N_BYTES_CHUNK_STORE = 64 * 1024
+store = None # The open SqliteStore, if any
+
+# Purpose: keep the pages under a cache directory in the page database from now on
+# Input: string (cache directory)
+def open_store (dir_base):
+    global store
+    store = SqliteStore (dir_base)
+
+# Purpose: get the database key of a page that is stored in the page database
+# Input: string (plain name of the page)
+# Output: (entry, page), or None if the page is not in the database
+def store_key (file_name):
+    if store == None:
+        return None
+    key = store.key (file_name)
+    if key == None or store.info (key) == None:
+        return None
+    return key
+
+# This defines the class SqliteStore (dir_base).
+# All access goes through one connection, shared by the download threads under a lock.
+class SqliteStore:
+    def __init__ (self, dir_base):
+        self.dir_base = os.path.abspath (dir_base)
+        self.lock = threading.Lock ()
+        self.conn = sqlite3.connect (os.path.join (self.dir_base, FILE_STORE), check_same_thread = False, isolation_level = None)
+        self.conn.text_factory = str
+        self.conn.execute ('PRAGMA auto_vacuum = INCREMENTAL') # Only takes effect in a new database
+        self.conn.execute ('PRAGMA journal_mode = WAL')
+        self.conn.execute ('PRAGMA synchronous = NORMAL')
+        self.conn.execute ('CREATE TABLE IF NOT EXISTS pages (entry TEXT, page TEXT, format TEXT, data BLOB, size INTEGER, mtime REAL, meta TEXT, PRIMARY KEY (entry, page))')
+        self.conn.execute ('CREATE TABLE IF NOT EXISTS chunks (entry TEXT, page TEXT, n INTEGER, data BLOB, PRIMARY KEY (entry, page, n))')
+        self.conn.execute ('CREATE TABLE IF NOT EXISTS entries (entry TEXT PRIMARY KEY, used REAL)')
+
+    # Purpose: get the key of a page, whether or not it is in the database
+    # Input: string (plain name of the page)
+    # Output: (entry, page), or None if the page is not directly inside an entry of the cache directory
+    def key (self, file_name):
+        dir_entry, page = os.path.split (os.path.abspath (file_name))
+        if os.path.dirname (dir_entry) != self.dir_base:
+            return None
+        return (os.path.basename (dir_entry), page)
+
+    # Purpose: run a query and get its first row
+    # Inputs: string (SQL), tuple of parameters
+    # Output: tuple (None if there is no result)
+    def query (self, sql, params):
+        with self.lock:
+            return self.conn.execute (sql, params).fetchone ()
+
+    # Purpose: run a statement
+    # Inputs: string (SQL), tuple of parameters
+    def execute (self, sql, params):
+        with self.lock:
+            self.conn.execute (sql, params)
+
+    # Purpose: get the format, size and modification time of a page
+    # Input: key
+    # Output: (format, number of bytes, time) or None if the page is not in the database
+    def info (self, key):
+        return self.query ('SELECT format, size, mtime FROM pages WHERE entry = ? AND page = ?', key)
+
+    # Purpose: get the stored data of a page
+    # Pages saved in one piece (pages.data) by earlier versions are still read.
+    # Input: key
+    # Output: (format, data as stored)
+    def data (self, key):
+        with self.lock:
+            row = self.conn.execute ('SELECT format, data FROM pages WHERE entry = ? AND page = ?', key).fetchone ()
+            if row [1] != None:
+                return (row [0], str (row [1]))
+            cursor = self.conn.execute ('SELECT data FROM chunks WHERE entry = ? AND page = ? ORDER BY n', key)
+            list_chunks = []
+            for row_chunk in cursor:
+                list_chunks.append (str (row_chunk [0]))
+        return (row [0], ''.join (list_chunks))
+
+    # Purpose: save a page, keeping its metadata
+    # The page is read and stored N_BYTES_CHUNK_STORE bytes at a time, in one transaction.
+    # Inputs: key, FORMAT_PLAIN or FORMAT_GZIP, file holding the data as stored
+    def put (self, key, page_format, local_file):
+        with self.lock:
+            self.conn.execute ('BEGIN')
+            try:
+                self.conn.execute ('INSERT OR IGNORE INTO pages (entry, page, meta) VALUES (?, ?, ?)', key + ('{}',))
+                self.conn.execute ('DELETE FROM chunks WHERE entry = ? AND page = ?', key)
+                n_bytes = 0
+                n = 0
+                while True:
+                    chunk = local_file.read (N_BYTES_CHUNK_STORE)
+                    if chunk == '':
+                        break
+                    self.conn.execute ('INSERT INTO chunks (entry, page, n, data) VALUES (?, ?, ?, ?)', key + (n, sqlite3.Binary (chunk)))
+                    n_bytes = n_bytes + len (chunk)
+                    n = n + 1
+                self.conn.execute ('UPDATE pages SET format = ?, data = NULL, size = ?, mtime = ? WHERE entry = ? AND page = ?',
+                                   (page_format, n_bytes, time.time ()) + key)
+                self.conn.execute ('COMMIT')
+            except:
+                self.conn.execute ('ROLLBACK')
+                raise
+
+    # Purpose: mark a page as new again
+    # Input: key
+    def touch_page (self, key):
+        self.execute ('UPDATE pages SET mtime = ? WHERE entry = ? AND page = ?', (time.time (),) + key)
+
+    # Purpose: read the metadata of a page
+    # Input: key
+    # Output: dict
+    def read_meta (self, key):
+        row = self.query ('SELECT meta FROM pages WHERE entry = ? AND page = ?', key)
+        try:
+            return json.loads (row [0])
+        except:
+            return {}
+
+    # Purpose: save the metadata of a page
+    # Inputs: key, dict
+    def write_meta (self, key, dict_meta):
+        self.execute ('UPDATE pages SET meta = ? WHERE entry = ? AND page = ?', (json.dumps (dict_meta),) + key)
+
+    # Purpose: mark an entry as used now
+    # Input: string (entry)
+    def touch_entry (self, entry):
+        self.execute ('INSERT OR REPLACE INTO entries (entry, used) VALUES (?, ?)', (entry, time.time ()))
+
+    # Purpose: list the entries in the database
+    # Output: list of (name, number of bytes, number of pages, time last used)
+    def list_entries (self):
+        with self.lock:
+            cursor = self.conn.execute ('SELECT p.entry, SUM (p.size) + SUM (LENGTH (p.meta)), COUNT (*), COALESCE (e.used, MAX (p.mtime)) FROM pages p LEFT JOIN entries e ON e.entry = p.entry GROUP BY p.entry')
+            return cursor.fetchall ()
+
+    # Purpose: remove the pages of an entry
+    # Input: string (entry)
+    def delete_entry (self, entry):
+        with self.lock:
+            self.conn.execute ('DELETE FROM pages WHERE entry = ?', (entry,))
+            self.conn.execute ('DELETE FROM chunks WHERE entry = ?', (entry,))
+            self.conn.execute ('DELETE FROM entries WHERE entry = ?', (entry,))
+
+    # Purpose: give the space freed by removed pages back to the file system
+    def vacuum (self):
+        self.execute ('PRAGMA incremental_vacuum', ())
+
+# Outcomes recorded in the Journal
+OUTCOME_OK = 'ok' # Downloaded, or confirmed unchanged
+OUTCOME_NOT_FOUND = 'not-found' # The server reported that the page does not exist
+OUTCOME_INVALID = 'invalid' # The page arrived but was not usable (see PAGE VALIDATION in fetch.py)
+OUTCOME_FAILED = 'failed' # Gave up after repeated errors; tried again when the run is resumed
+N_RECORDS_SYNC = 100 # The journal is forced to disk after this many records
+
+# This defines the class Journal (file_name, age_max_hours).
+# It is an append-only log of download outcomes, one line per page: time, outcome, URL (separated by tabs).
+# The journal of a run that stops before calling finish is left on disk.  The next run reads it and skips the pages
+# that were already finished, so it resumes where the interrupted run stopped.
+# age_max_hours: records older than this are ignored (the pages are due to be checked again anyway)
+class Journal:
+    def __init__ (self, file_name, age_max_hours):
+        self.file_name = file_name
+        self.age_max_hours = age_max_hours
+        self.lock = threading.Lock ()
+        self.dict_outcome = {} # URL -> (time, outcome) of the latest record
+        self.local_file = None
+        self.n_unsynced = 0
+
+    # Purpose: read the journal left by an interrupted run, then open it for new records
+    # Output: integer (number of pages finished in the interrupted run)
+    def open (self):
+        try:
+            with open (self.file_name, 'r') as f:
+                for line in f:
+                    try:
+                        str_time, outcome, url = line.rstrip ('\n').split ('\t')
+                        self.dict_outcome [url] = (float (str_time), outcome)
+                    except ValueError:
+                        pass # Last line cut short by the interruption
+        except IOError:
+            pass
+        self.local_file = open (self.file_name, 'a')
+        n_finished = 0
+        for url in self.dict_outcome:
+            if self.finished (url):
+                n_finished = n_finished + 1
+        return n_finished
+
+    # Purpose: determine whether a page was already finished in the interrupted run
+    # Input: string (URL)
+    # Output: True or False
+    def finished (self, url):
+        with self.lock:
+            entry = self.dict_outcome.get (url)
+        if entry == None:
+            return False
+        t, outcome = entry
+        if time.time () - t > 3600 * self.age_max_hours:
+            return False
+        return outcome in (OUTCOME_OK, OUTCOME_NOT_FOUND, OUTCOME_INVALID)
+
+    # Purpose: add a record to the journal
+    # Inputs: string (URL), string (outcome)
+    def record (self, url, outcome):
+        now = time.time ()
+        with self.lock:
+            self.dict_outcome [url] = (now, outcome)
+            if self.local_file == None:
+                return
+            self.local_file.write (repr (now) + '\t' + outcome + '\t' + url + '\n')
+            self.local_file.flush ()
+            self.n_unsynced = self.n_unsynced + 1
+            if self.n_unsynced >= N_RECORDS_SYNC:
+                os.fsync (self.local_file.fileno ())
+                self.n_unsynced = 0
+
+    # Purpose: close and delete the journal once the run has finished normally
+    def finish (self):
+        with self.lock:
+            if self.local_file != None:
+                self.local_file.close ()
+                self.local_file = None
+        try:
+            os.remove (self.file_name)
+        except OSError:
+            pass
+
+# This defines the class NegativeCache (file_name, ttl_hours, list_markers, ttl_invalid_hours).
+# It remembers the URLs of pages that do not exist upstream (delisted symbols, preferred shares, odd tickers):
+# "404 Not Found" responses, empty pages, and pages containing one of the "not found" messages in list_markers.
+# Such a URL is not requested again until ttl_hours have passed.
+# It also holds back the pages rejected by a validator (a login wall, an empty template; see PAGE VALIDATION in
+# fetch.py) for the much shorter ttl_invalid_hours, after which they are tried again: such a page may well be fine
+# once the blocking episode is over.
+# The cache is kept in a JSON file (URL -> [time recorded, hours to keep]).
+class NegativeCache:
+    def __init__ (self, file_name, ttl_hours, list_markers = None, ttl_invalid_hours = 12):
+        self.file_name = file_name
+        self.ttl_hours = ttl_hours
+        self.ttl_invalid_hours = ttl_invalid_hours
+        self.list_markers = list_markers or []
+        self.lock = threading.Lock ()
+        self.dict_missing = {} # URL -> (time recorded, hours to keep)
+        self.n_skipped = 0
+        self.n_added = 0
+        self.n_added_invalid = 0
+
+    # Purpose: read the cache saved by the previous run, dropping the entries that have expired
+    # A cache saved by an earlier version (URL -> time recorded) is read with ttl_hours for every entry.
+    def load (self):
+        try:
+            with open (self.file_name, 'r') as f:
+                dict_saved = json.load (f)
+        except:
+            dict_saved = {}
+        now = time.time ()
+        with self.lock:
+            for url in dict_saved:
+                entry = dict_saved [url]
+                if isinstance (entry, list):
+                    t, ttl_hours = entry
+                else:
+                    t, ttl_hours = entry, self.ttl_hours
+                if now - t < 3600 * ttl_hours:
+                    self.dict_missing [url] = (t, ttl_hours)
+
+    # Purpose: save the cache for the next run
+    def save (self):
+        with self.lock:
+            dict_saved = {}
+            for url in self.dict_missing:
+                dict_saved [url] = list (self.dict_missing [url])
+        file_tmp = self.file_name + '.tmp'
+        with open (file_tmp, 'w') as f:
+            json.dump (dict_saved, f)
+        os.rename (file_tmp, self.file_name)
+
+    # Purpose: determine whether a page is known not to exist or held back for now (counts the skipped downloads)
+    # Input: string (URL)
+    # Output: True or False
+    def missing (self, url):
+        with self.lock:
+            entry = self.dict_missing.get (url)
+            if entry == None or time.time () - entry [0] >= 3600 * entry [1]:
+                return False
+            self.n_skipped = self.n_skipped + 1
+            return True
+
+    # Purpose: determine whether downloaded contents mean that the page does not exist
+    # Input: string (contents)
+    # Output: True or False
+    def is_missing_page (self, contents):
+        if contents.strip () == '':
+            return True
+        for marker in self.list_markers:
+            if marker in contents:
+                return True
+        return False
+
+    # Purpose: record a page that does not exist
+    # Input: string (URL)
+    def add (self, url):
+        with self.lock:
+            self.dict_missing [url] = (time.time (), self.ttl_hours)
+            self.n_added = self.n_added + 1
+
+    # Purpose: hold back a page rejected by a validator until it is due to be tried again
+    # Input: string (URL)
+    def add_invalid (self, url):
+        with self.lock:
+            self.dict_missing [url] = (time.time (), self.ttl_invalid_hours)
+            self.n_added_invalid = self.n_added_invalid + 1
+
+    # Purpose: forget a page that turned out to exist
+    # Input: string (URL)
+    def remove (self, url):
+        with self.lock:
+            if url in self.dict_missing:
+                del self.dict_missing [url]
+
+    # Purpose: summarize the use of the cache in this run
+    # Output: string
+    def stats (self):
+        with self.lock:
+            n_known = len (self.dict_missing)
+        return "Missing pages: " + str(self.n_skipped) + " skipped, " + str(self.n_added) + " newly found, " + str(self.n_added_invalid) + " invalid held back for " + str(self.ttl_invalid_hours) + " hours, " + str(n_known) + " known"
+
+# CACHE SIZE
+# An entry is a directory directly under the cache directory (screen-downloads/KO); files directly under the cache
+# directory (the journal, the negative cache) are not entries and are never removed.
+# An entry counts as used when the script touches it (touch_entry), which it does for every stock in a run,
+# whether or not its pages needed downloading.
+# With the page database open, an entry's pages may be in the database, in its directory, or both.
+
+# Purpose: mark an entry as used now
+# Input: string (path of the entry)
+def touch_entry (path):
+    if store != None and os.path.dirname (os.path.abspath (path)) == store.dir_base:
+        store.touch_entry (os.path.basename (path))
+    try:
+        os.utime (path, None)
+    except OSError:
+        pass
+
+# Purpose: list the entries of a cache directory
+# Input: string (cache directory)
+# Output: list of (name, number of bytes, number of files, time last used), least recently used first
+def list_entries (dir_base):
+    list_output = []
+    for name in os.listdir (dir_base):
+        path = os.path.join (dir_base, name)
+        if not os.path.isdir (path):
+            continue
+        n_bytes = 0
+        n_files = 0
+        for name_file in os.listdir (path):
+            try:
+                n_bytes = n_bytes + os.path.getsize (os.path.join (path, name_file))
+                n_files = n_files + 1
+            except OSError:
+                pass
+        list_output.append ((name, n_bytes, n_files, os.path.getmtime (path)))
+    if store != None and store.dir_base == os.path.abspath (dir_base):
+        dict_entries = {}
+        for entry in list_output:
+            dict_entries [entry [0]] = entry
+        for name, n_bytes, n_files, t_used in store.list_entries ():
+            if name in dict_entries:
+                name, n_bytes_dir, n_files_dir, t_used_dir = dict_entries [name]
+                n_bytes = n_bytes + n_bytes_dir
+                n_files = n_files + n_files_dir
+                t_used = max (t_used, t_used_dir)
+            dict_entries [name] = (name, n_bytes, n_files, t_used)
+        list_output = dict_entries.values ()
+    list_output.sort (key = lambda entry: entry [3])
+    return list_output
+
+# Purpose: summarize the contents of a cache directory
+# Input: string (cache directory)
+# Output: string
+def cache_stats (dir_base):
+    list_entries_all = list_entries (dir_base)
+    n_bytes = sum ([entry [1] for entry in list_entries_all])
+    n_files = sum ([entry [2] for entry in list_entries_all])
+    str_output = "Cache: " + str(len (list_entries_all)) + " entries, " + str(n_files) + " files, " + '{0:.1f}'.format (n_bytes / 1048576.0) + " MB"
+    if list_entries_all != []:
+        n_days = (time.time () - list_entries_all [0][3]) / 86400
+        str_output = str_output + "; least recently used " + '{0:.1f}'.format (n_days) + " days ago"
+    return str_output
+
+# Purpose: remove entries until the cache is within its budget
+# Entries whose names are not in set_keep (stocks no longer listed) are removed first, then the least recently used.
+# Inputs: string (cache directory), maximum number of bytes, maximum number of entries,
+# set of entry names still wanted (None to keep every entry that fits the budget)
+# Output: (number of entries removed, number of bytes freed)
+def evict (dir_base, n_bytes_max, n_entries_max, set_keep = None):
+    list_entries_all = list_entries (dir_base)
+    n_bytes = sum ([entry [1] for entry in list_entries_all])
+    n_entries = len (list_entries_all)
+    list_remove = []
+    list_lru = []
+    for entry in list_entries_all:
+        if set_keep != None and not (entry [0] in set_keep):
+            list_remove.append (entry)
+        else:
+            list_lru.append (entry)
+    for entry in list_remove:
+        n_bytes = n_bytes - entry [1]
+        n_entries = n_entries - 1
+    for entry in list_lru:
+        if n_bytes <= n_bytes_max and n_entries <= n_entries_max:
+            break
+        list_remove.append (entry)
+        n_bytes = n_bytes - entry [1]
+        n_entries = n_entries - 1
+    n_bytes_freed = 0
+    for entry in list_remove:
+        shutil.rmtree (os.path.join (dir_base, entry [0]), ignore_errors = True)
+        if store != None and store.dir_base == os.path.abspath (dir_base):
+            store.delete_entry (entry [0])
+        n_bytes_freed = n_bytes_freed + entry [1]
+    if store != None and list_remove != []:
+        store.vacuum ()
+    return (len (list_remove), n_bytes_freed)
+
+if __name__ == '__main__':
+    if len (sys.argv) >= 3 and os.path.exists (os.path.join (sys.argv [2], FILE_STORE)):
+        open_store (sys.argv [2])
+    if len (sys.argv) == 3 and sys.argv [1] == 'stats':
+        print cache_stats (sys.argv [2])
+    elif len (sys.argv) == 5 and sys.argv [1] == 'evict':
+        n_removed, n_bytes_freed = evict (sys.argv [2], float (sys.argv [3]) * 1048576, int (sys.argv [4]))
+        print "Removed " + str(n_removed) + " entries, " + '{0:.1f}'.format (n_bytes_freed / 1048576.0) + " MB"
+        print cache_stats (sys.argv [2])
+    else:
+        print "Usage: python pagestore.py stats DIRECTORY"
+        print "       python pagestore.py evict DIRECTORY MAX_MEGABYTES MAX_ENTRIES"
+        sys.exit (1)
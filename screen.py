@@ -19,7 +19,6 @@ import sys
 import os
 import csv
 import datetime
-import signal
 import urllib2
 import time, random
 import socket
@@ -29,6 +28,16 @@ import lxml.html
 import re
 import math
 import operator
+import Queue
+import json
+import calendar
+import argparse
+
+import fetch
+import pagestore
+import secdata
+from fetch import download_page_shared
+from pages import get_units, validate_page
 
 ##########################################################################################
 # PART 1: FIGURE OUT THE DIRECTORY STRUCTURE
@@ -59,8 +68,100 @@ dir_output = dir_screen + '/screen-output'
 # PART 2: DECIDE WHETHER TO ANALYZE ALL 5000+ STOCKS OR JUST A SMALL TEST GROUP
 # (DEVELOPMENT ENVIRONMENT ONLY)
 ###############################################################################
+
+# RUN DEADLINE
+# --deadline HH:MM (local time) or --budget MINUTES (counted from the start of the script) limits the run.
+# When the deadline is reached, no new downloads are started; the pages in flight are finished, every stock is
+# analyzed from the pages already saved, and the results are published as usual.
+# The stocks whose downloads were skipped are saved in FILE_CARRYOVER (PART 6) and downloaded first next time.
+time_start = time.time ()
+parser = argparse.ArgumentParser (description = 'Dopeler Value Investing stock screen')
+parser.add_argument ('--deadline', help = 'stop downloading at this local time (HH:MM)')
+parser.add_argument ('--budget', type = float, help = 'stop downloading after this many minutes')
+parser.add_argument ('--window', help = 'spread the downloads evenly until the end of this UTC window (HH:MM-HH:MM)')
+parser.add_argument ('--offline', action = 'store_true', help = 'use only the pages already saved (no network access)')
+parser.add_argument ('--long', action = 'store_true', help = 'run the long version without asking')
+parser.add_argument ('--short', action = 'store_true', help = 'run the short version without asking')
+parser.add_argument ('--sec-archive', action = 'append', metavar = 'ZIP', help = 'take the Smartmoney figures from this SEC financial statement data set archive instead (may be given more than once)')
+args = parser.parse_args ()
+
+# Purpose: get the time at which downloading must stop
+# Inputs: string (HH:MM or None), number of minutes (or None)
+# Output: time in seconds since the epoch (None if there is no limit)
+# A clock time that has already passed today refers to tomorrow.  If both limits are given, the earlier one applies.
+def time_deadline (str_deadline, n_minutes_budget):
+    list_times = []
+    if str_deadline != None:
+        t_clock = datetime.datetime.strptime (str_deadline, '%H:%M').time ()
+        dt_deadline = datetime.datetime.combine (datetime.date.today (), t_clock)
+        if dt_deadline <= datetime.datetime.now ():
+            dt_deadline = dt_deadline + datetime.timedelta (days = 1)
+        list_times.append (time.mktime (dt_deadline.timetuple ()))
+    if n_minutes_budget != None:
+        list_times.append (time_start + n_minutes_budget * 60)
+    if list_times == []:
+        return None
+    return min (list_times)
+
+# NIGHT WINDOW
+# --window START-END (UTC, for example 05:00-09:00) spreads the requests evenly, with some jitter, over the time
+# left until END (see NIGHT WINDOW in fetch.py).  The downloads start at once, and END also acts as a deadline.
+# A window may span midnight (22:00-02:00).  A run started outside the window downloads nothing, as if its deadline
+# had passed (the stocks are carried over to the next run).
+# Purpose: get the end of the night window
+# Input: string (HH:MM-HH:MM, UTC)
+# Output: time in seconds since the epoch (None if the clock is not between START and END now)
+def time_window_end (str_window):
+    str_start, str_end = str_window.split ('-')
+    t_clock_start = datetime.datetime.strptime (str_start, '%H:%M').time ()
+    t_clock_end = datetime.datetime.strptime (str_end, '%H:%M').time ()
+    now = datetime.datetime.utcnow ()
+    dt_start = datetime.datetime.combine (now.date (), t_clock_start)
+    dt_end = datetime.datetime.combine (now.date (), t_clock_end)
+    if dt_end <= dt_start: # The window spans midnight
+        if now < dt_end:
+            dt_start = dt_start - datetime.timedelta (days = 1)
+        else:
+            dt_end = dt_end + datetime.timedelta (days = 1)
+    if now < dt_start or now >= dt_end:
+        return None
+    return calendar.timegm (dt_end.timetuple ())
+
+deadline = time_deadline (args.deadline, args.budget)
+if args.window != None and not (args.offline):
+    t_window_end = time_window_end (args.window)
+    if t_window_end == None:
+        print "Outside the night window " + args.window + " (UTC) - no downloads"
+        deadline = time.time ()
+    else:
+        fetch.pace_until (t_window_end)
+        if deadline == None or t_window_end < deadline:
+            deadline = t_window_end
+        print "Requests spread evenly until " + time.strftime ('%Y-%m-%d %H:%M', time.localtime (t_window_end))
+if deadline != None:
+    print "Downloads stop at " + time.strftime ('%Y-%m-%d %H:%M', time.localtime (deadline))
+
+# OFFLINE MODE
+# With --offline, the analysis is run again from the pages already saved in screen-input and screen-downloads,
+# for example after changing a threshold in PART 7.  No connection is opened, however old the pages are,
+# and a page that was never saved counts as missing data.
+# The journal and the carry-over file of the online runs are left alone.
+# An offline run never asks which version to run: without --long, it runs the short version in the development
+# environment (and the long version on the server, as usual).
+if args.offline:
+    fetch.go_offline ()
+    print "Offline mode: using only the pages already saved"
+
 run_long = True # By default, run the long version of the script
-if not (is_server): # Offer a choice in the development environment
+if args.long:
+    print "Running the long version"
+elif args.short:
+    run_long = False
+    print "Running the short version"
+elif args.offline and not (is_server):
+    run_long = False
+    print "Running the short version (offline; use --long for the long version)"
+elif not (is_server): # Offer a choice in the development environment
     print ("The long version of this script analyzes 5000+ stocks.")
     print ("The alternative is a quick version that just analyzes a few dozen stocks.")
     y_or_n = raw_input('Do you wish to run the long version?  (Y/N)\n')
@@ -75,68 +176,6 @@ if not (is_server): # Offer a choice in the development environment
 # PART 3: DOWNLOAD THE LISTS OF AMEX, NYSE, AND NASDAQ STOCKS FROM THE NASDAQ WEB SITE
 ######################################################################################
 
-# Get age of file
-# Based on solution at 
-# http://stackoverflow.com/questions/5799070/how-to-see-if-file-is-older-than-3-months-in-python
-# Returns a billion if the file does not exist
-def age_of_file (file1): # In hours
-    now = datetime.datetime.now ()
-    try:
-        modified_date = datetime.datetime.fromtimestamp(os.path.getmtime(file1))
-        age = now - modified_date
-        age_days = age.days 
-        age_seconds = age.seconds
-        age_hours = 24 * age_days + age_seconds/3600
-        return age_hours
-    except:
-        return 1000000000
-
-class TimeoutException(Exception): 
-    pass
-
-def timeout_handler(signum, frame):
-    raise TimeoutException()
-
-# Download a page from a url and save it
-# Only download if the existing page is at least 4 days old.
-# If the download is not successful, make up to 2 additional attempts.
-# Inputs: URL of source, path of destination
-# Times out after 10 seconds
-def download_page (url, file_name, file_age_max_hours):
-    from urllib2 import Request, urlopen, URLError, HTTPError
-    file_age = age_of_file (file_name) # In hours
-    file_size = 0
-    try:
-        file_size = os.path.getsize (file_name)
-    except:
-        file_size = 0
-    n_fail = 0
-    n_fail_max = 2
-    while ((file_age > file_age_max_hours or file_size == 0) and n_fail <= n_fail_max):
-        try:
-            f = urllib2.urlopen (url)
-            local_file = open (file_name, 'w') # Open local file
-            local_file.write (f.read())
-            local_file.close ()
-            time.sleep (random.uniform (.1, .2)) # Delay is needed to limit the impact on the upstream server
-            break # Script hangs without this command
-        except urllib2.HTTPError, e:
-            n_fail = n_fail + 1
-            print "Failure #: " + str (n_fail)
-            print "HTTP Error:",e.code , url
-        except urllib2.URLError, e:
-            n_fail = n_fail + 1
-            print "Failure #: " + str (n_fail)
-            print "URL Error:",e.reason , url
-        except Exception,e: 
-            n_fail = n_fail + 1
-            print "Failure #: " + str (n_fail)
-            print str(e)
-    if n_fail > n_fail_max:
-        print "Download failed, giving up"
-    if file_age <= file_age_max_hours and file_size > 0:
-        print "Local file is new enough - skipping download"
-
 # Purpose: download the CSV file listing all stocks on the exchange
 # http://www.nasdaq.com/screening/companies-by-industry.aspx?exchange=NASDAQ&render=download
 if run_long:
@@ -153,11 +192,11 @@ if run_long:
     file_age_max_hours = 12
 
     print ('Downloading list of AMEX stocks')
-    download_page (url1, file1, file_age_max_hours)
+    download_page_shared (url1, file1, file_age_max_hours, validator = fetch.validate_exchange_list)
     print ('Downloading list of NYSE stocks')
-    download_page (url2, file2, file_age_max_hours)
+    download_page_shared (url2, file2, file_age_max_hours, validator = fetch.validate_exchange_list)
     print ('Downloading list of NASDAQ stocks')
-    download_page (url3, file3, file_age_max_hours)
+    download_page_shared (url3, file3, file_age_max_hours, validator = fetch.validate_exchange_list)
 
 ##############################################################################################
 # PART 4: For a given exchange, obtain a list of ticker symbols for stocks that are NOT funds.
@@ -484,6 +523,7 @@ Exchange1 = Exchange ('test')
 list_symbol = Exchange1.symbol_selected ()
 list_name = Exchange1.name_selected ()
 list_price = Exchange1.price_selected ()
+list_marketcap = Exchange1.marketcap_selected ()
 list_nshares = Exchange1.nshares_selected ()
 list_sector = Exchange1.sector_selected ()
 list_industry = Exchange1.industry_selected ()
@@ -499,12 +539,57 @@ if run_long:
     list_symbol = Exchange1.symbol_selected () + Exchange2.symbol_selected () + Exchange3.symbol_selected ()
     list_name = Exchange1.name_selected () + Exchange2.name_selected () + Exchange3.name_selected ()
     list_price = Exchange1.price_selected () + Exchange2.price_selected () + Exchange3.price_selected ()
+    list_marketcap = Exchange1.marketcap_selected () + Exchange2.marketcap_selected () + Exchange3.marketcap_selected ()
     list_nshares = Exchange1.nshares_selected () + Exchange2.nshares_selected () + Exchange3.nshares_selected ()
     list_sector = Exchange1.sector_selected () + Exchange2.sector_selected () + Exchange3.sector_selected ()
     list_industry = Exchange1.industry_selected () + Exchange2.industry_selected () + Exchange3.industry_selected ()
 
 # END: enable this section for analyzing all AMEX, NYSE, and NASDAQ stocks
 
+# SCREENING FUNNEL, STAGE 1: THE EXCHANGE LISTS
+# The stocks are screened in stages, from the cheapest to the most expensive (see SCREENING FUNNEL in PART 6).
+# This first stage costs nothing: it removes the stocks that the exchange lists alone rule out, before any of their
+# statements are downloaded.
+# LIST_CLASS_MARKERS: symbols of share classes other than common stock (preferred shares, warrants, rights, units)
+LIST_CLASS_MARKERS = ['^', '.WS', '.RT', '.U']
+
+# Purpose: get the reason why the exchange lists rule out a stock
+# Input: position in list_symbol
+# Output: string (None if the stock is still a candidate)
+def reason_list_stage (i_stock):
+    if list_price [i_stock] == None or list_price [i_stock] <= 0:
+        return 'no price'
+    if list_marketcap [i_stock] == None or list_marketcap [i_stock] <= 0:
+        return 'no market cap'
+    for marker in LIST_CLASS_MARKERS:
+        if marker in list_symbol [i_stock]:
+            return 'share class'
+    return None
+
+dict_n_removed_list = {} # Reason -> number of stocks removed
+list_keep = []
+i_stock = 0
+while i_stock < len (list_symbol):
+    reason = reason_list_stage (i_stock)
+    if reason == None:
+        list_keep.append (i_stock)
+    else:
+        dict_n_removed_list [reason] = dict_n_removed_list.get (reason, 0) + 1
+    i_stock = i_stock + 1
+n_listed = len (list_symbol)
+set_symbol_listed = set (list_symbol) # Every stock in the exchange lists, kept or not (see CACHE SIZE)
+list_symbol = [list_symbol [i] for i in list_keep]
+list_name = [list_name [i] for i in list_keep]
+list_price = [list_price [i] for i in list_keep]
+list_marketcap = [list_marketcap [i] for i in list_keep]
+list_nshares = [list_nshares [i] for i in list_keep]
+list_sector = [list_sector [i] for i in list_keep]
+list_industry = [list_industry [i] for i in list_keep]
+str_removed_list = ''
+for reason in sorted (dict_n_removed_list):
+    str_removed_list = str_removed_list + ', ' + str(dict_n_removed_list [reason]) + ' ' + reason
+print "Exchange lists stage: " + str(n_listed) + " stocks in, " + str(n_listed - len (list_symbol)) + " removed" + str_removed_list + "; cost: no downloads"
+
 num_stocks = len (list_symbol)
 print "Total number of stocks: " + str(num_stocks)
 print "FINISHED acquiring list of stocks"
@@ -573,62 +658,315 @@ def local_balancesheet_yahoo (symbol1):
     url1 = local_root (symbol1) + '/balancesheet-yahoo.html'
     return url1
 
+# File in which the data parsed from a stock's pages are kept, along with the content hashes of those pages
+def local_fields (symbol1):
+    url1 = local_root (symbol1) + '/fields.json'
+    return url1
 
 # Create directory path1 if it does not already exist
+# (The directory of each stock is created by pagestore when a page is saved in it.)
 def create_dir (path1):
     if not (os.path.exists(path1)):
         os.mkdir (path1)
 
-# Download information on a given stock
-def download_data_stock (symbol1, file_age_max_hours):
-    url1 = url_balancesheet (symbol1)
-    url2 = url_income (symbol1)
-    url3 = url_cashflow (symbol1)
-    url4 = url_balancesheet_yahoo (symbol1)
-    url5 = url_income_yahoo (symbol1)
-    local1 = local_balancesheet (symbol1)
-    local2 = local_income (symbol1)
-    local3 = local_cashflow (symbol1)    
-    local4 = local_balancesheet_yahoo (symbol1)
-    local5 = local_income_yahoo (symbol1)
-
-    # NOTE: Alternating between downloading from Smartmoney and downloading from Yahoo Finance
-    # to limit impact on their servers
-    print "Downloading data on " + symbol1
-    print "Downloading balance sheet data"
-    download_page (url1, local1, file_age_max_hours)
-
-    print "Downloading Yahoo balance sheet data"
-    download_page (url4, local4, file_age_max_hours)
-
-    print "Downloading income statement data"
-    download_page (url2, local2, file_age_max_hours)
-
-    print "Downloading Yahoo income data"
-    download_page (url5, local5, file_age_max_hours)
-
-    print "Downloading cash flow data"
-    download_page (url3, local3, file_age_max_hours)
-    
+# Pages to download for a given stock, one group for each stage of the SCREENING FUNNEL below
+# The Smartmoney pages are not needed for the stocks whose figures come from the SEC ARCHIVES below.
+# Smartmoney balance sheet
+# Input: stock symbol
+# Output: list of (URL, local file, maximum age in hours)
+def jobs_balancesheet (symbol1, file_age_max_hours):
+    list_jobs = []
+    if symbol1 in dict_sec:
+        return list_jobs
+    list_jobs.append ((url_balancesheet (symbol1), local_balancesheet (symbol1), file_age_max_hours))
+    return list_jobs
+
+# Smartmoney income and cash flow statements
+# Input: stock symbol
+# Output: list of (URL, local file, maximum age in hours)
+def jobs_income_cashflow (symbol1, file_age_max_hours):
+    list_jobs = []
+    if symbol1 in dict_sec:
+        return list_jobs
+    list_jobs.append ((url_income (symbol1), local_income (symbol1), file_age_max_hours))
+    list_jobs.append ((url_cashflow (symbol1), local_cashflow (symbol1), file_age_max_hours))
+    return list_jobs
+
+# Yahoo Finance pages to download for a given stock
+# Input: stock symbol
+# Output: list of (URL, local file, maximum age in hours)
+def jobs_stock_yahoo (symbol1, file_age_max_hours):
+    list_jobs = []
+    list_jobs.append ((url_balancesheet_yahoo (symbol1), local_balancesheet_yahoo (symbol1), file_age_max_hours))
+    list_jobs.append ((url_income_yahoo (symbol1), local_income_yahoo (symbol1), file_age_max_hours))
+    return list_jobs
+
+# REFRESH SCHEDULE
+# Annual statements only change when a new annual report is filed, so each stock's pages are refreshed according
+# to the end of the latest fiscal year seen in its data (see get_fy_end in PART 7).
+# The next annual report is expected DAYS_FILING_START to DAYS_FILING_END days after the end of the next fiscal year.
+# (10-K deadlines are 60 to 90 days, 20-F deadlines are 120 days, and the data sites need some time to catch up.)
+# During that window the pages are checked every HOURS_REFRESH_DUE hours until the new fiscal year shows up.
+# Otherwise they are only checked every HOURS_REFRESH_QUIET hours (to catch restatements).
+# Stocks whose fiscal year-end is not known yet keep the old weekly schedule.
+HOURS_REFRESH_DEFAULT = 168
+HOURS_REFRESH_DUE = 72
+HOURS_REFRESH_QUIET = 24 * 120
+DAYS_FILING_START = 40
+DAYS_FILING_END = 130
+
+# Purpose: get the end of the latest fiscal year seen in a stock's data
+# Input: stock symbol
+# Output: datetime.date (None if not known)
+def fy_end_stock (symbol1):
+    try:
+        str_date = json.loads (pagestore.read_page (local_fields (symbol1))) ['fields']['fy_end']
+        return datetime.datetime.strptime (str_date, '%Y-%m-%d').date ()
+    except:
+        return None
+
+# Purpose: get the maximum age of a stock's pages before they are checked again
+# Inputs: stock symbol, datetime.date (today)
+# Output: number of hours
+def refresh_hours (symbol1, date_today = None):
+    date_today = date_today or datetime.date.today ()
+    fy_end = fy_end_stock (symbol1)
+    if fy_end == None:
+        return HOURS_REFRESH_DEFAULT
+    fy_end_next = fy_end + datetime.timedelta (days = 365)
+    date_start = fy_end_next + datetime.timedelta (days = DAYS_FILING_START)
+    date_end = fy_end_next + datetime.timedelta (days = DAYS_FILING_END)
+    if date_start <= date_today <= date_end:
+        return HOURS_REFRESH_DUE
+    return HOURS_REFRESH_QUIET
+
+# DOWNLOAD ORDER
+# The stocks that matter most are downloaded first, so that a run cut short still refreshes them.
+# The order comes from the previous run's results-unfiltered.csv (PART 10):
+# 1. stocks that passed every filter, then stocks that failed the fewest filters
+#    (a stock missing from the previous results counts as failing N_FLAGS_UNKNOWN filters)
+# 2. within each of those groups, the lowest Dopeler P/B first
+# Fund-like names and stocks for which no data at all could be found last time come after everything else.
+# A stock only counts as without data if neither source had its assets, and the Yahoo Finance cross-check was actually
+# made (a stock removed early by the SCREENING FUNNEL below has its cross-check flags left as None).
+FILE_RESULTS_PREVIOUS = dir_output + '/results-unfiltered.csv'
+LIST_FLAG_TITLES = ['Assets\nSuspect?', 'Rev.\nSuspect?', 'PPE\nSuspect?', 'ROE\nLow?', 'No\nDopeler\nBook\nValue?']
+N_FLAGS_UNKNOWN = 2
+N_FLAGS_LAST = len (LIST_FLAG_TITLES) + 1
+LIST_FUND_WORDS = ['Fund', 'ETF', 'ETN', 'Portfolio']
+
+# Purpose: read the previous run's results
+# Output: dict of symbol -> (number of filters failed, Dopeler P/B or None, True if no data was found)
+def results_previous ():
+    dict_output = {}
+    try:
+        list_results = CSVfile (FILE_RESULTS_PREVIOUS).filelist ()
+        list_symbol_prev = col_title (list_results, 'Symbol')
+        list_pb_prev = col_title (list_results, 'Dopeler\nP/B')
+        list_assets_sm = col_title (list_results, 'Assets\n(billions,\nSmartMoney)')
+        list_assets_y = col_title (list_results, 'Assets\n(billions,\nYahoo)')
+        list_assets_suspect_prev = col_title (list_results, 'Assets\nSuspect?')
+        list_list_flags = []
+        for title in LIST_FLAG_TITLES:
+            list_list_flags.append (col_title (list_results, title))
+    except:
+        return dict_output # No previous results, or results in an older layout
+    n = 0
+    while n < len (list_symbol_prev):
+        n_flags = 0
+        for list_flags in list_list_flags:
+            if list_flags [n] == 'True':
+                n_flags = n_flags + 1
+        checked_yahoo = list_assets_suspect_prev [n] != 'None'
+        no_data = (list_assets_sm [n] == 'None') and checked_yahoo and (list_assets_y [n] == 'None')
+        dict_output [list_symbol_prev [n]] = (n_flags, str_to_float (list_pb_prev [n]), no_data)
+        n = n + 1
+    return dict_output
+
+# Purpose: tell whether a name looks like that of a fund rather than a company
+# Input: string
+# Output: boolean
+def is_fund_name (name):
+    list_words = name.replace (',', ' ').replace ('.', ' ').split ()
+    for word in LIST_FUND_WORDS:
+        if word in list_words:
+            return True
+    return False
+
+# Stocks whose downloads were skipped because the previous run reached its deadline (see RUN DEADLINE in PART 2)
+# They are downloaded before all others, in their usual order, unless they are fund-like or without data.
+FILE_CARRYOVER = dir_downloads + '/carryover.txt'
+
+# Purpose: read the stocks carried over from the previous run
+# Output: set of stock symbols
+def read_carryover ():
+    set_output = set ()
+    if os.path.exists (FILE_CARRYOVER):
+        with open (FILE_CARRYOVER, 'r') as f:
+            for line in f:
+                if line.strip () != '':
+                    set_output.add (line.strip ())
+    return set_output
+
+# Purpose: save the stocks to carry over to the next run (the file is removed if there are none)
+# Input: list of stock symbols
+def write_carryover (list_symbols):
+    if list_symbols == []:
+        if os.path.exists (FILE_CARRYOVER):
+            os.remove (FILE_CARRYOVER)
+        return
+    with open (FILE_CARRYOVER, 'w') as f:
+        for symbol1 in list_symbols:
+            f.write (symbol1 + '\n')
+
+# Purpose: get the download priority of a stock (lower values are downloaded first)
+# Inputs: stock symbol, stock name, dict from results_previous, set of symbols carried over
+# Output: (number of filters failed, Dopeler P/B), preceded by -1 for a stock carried over
+def priority_stock (symbol1, name1, dict_prev, set_carryover):
+    if is_fund_name (name1):
+        return (N_FLAGS_LAST, None)
+    if not (symbol1 in dict_prev):
+        priority = (N_FLAGS_UNKNOWN, float ('inf'))
+    else:
+        n_flags, pb, no_data = dict_prev [symbol1]
+        if no_data:
+            return (N_FLAGS_LAST, None)
+        if pb == None or pb <= 0:
+            pb = float ('inf') # Unknown or negative P/B goes after every real one
+        priority = (n_flags, pb)
+    if symbol1 in set_carryover:
+        priority = (-1,) + priority
+    return priority
+
+# SCREENING FUNNEL
+# After the exchange lists (PART 5), the stocks go through the stages of LIST_STAGES in order.
+# Each stage declares the pages it needs and the test a stock must pass to move on to the next stage.
+# A stock is analyzed (PART 7) every time a stage's pages arrive, using the pages already saved for the later stages
+# (if any), and only the stocks that pass a stage's test have the next stage's pages downloaded:
+# 1. Smartmoney balance sheet: PPE growth must be steady (ppe_suspect)
+# 2. Smartmoney income and cash flow statements: Dopeler ROE and intrinsic value (roe_low, iv_none)
+# 3. Yahoo Finance balance sheet and income statement: cross-checks of assets and revenue (assets_suspect, rev_suspect)
+# Only a stock that passes every filter appears in results.csv, so removing the others early does not change it.
+# A stock removed before the last stage is cross-checked against whatever Yahoo Finance pages are already saved,
+# if any; without them, its cross-check flags are left as None (not checked) rather than True.
+# The tests read the lists filled in by PART 7.
+# For a stock whose figures come from the SEC ARCHIVES, the first two stages have no pages to download, so its
+# stages are only a matter of analyzing it.
+
+# This defines the class Stage (name, jobs, test).
+# Inputs: string, function (stock symbol, maximum age in hours) -> list of jobs,
+# function (position in list_symbol) -> boolean (None for the last stage)
+# It also counts the stocks that entered the stage, the stocks it removed, and the pages it checked and downloaded.
+class Stage:
+    def __init__ (self, name, jobs, test):
+        self.name = name
+        self.jobs = jobs
+        self.test = test
+        self.n_in = 0
+        self.n_removed = 0
+        self.n_pages = 0
+        self.n_downloaded = 0
+
+    # Purpose: report what the stage removed and what it cost
+    # Output: string
+    def stats (self):
+        return self.name + " stage: " + str(self.n_in) + " stocks in, " + str(self.n_removed) + " removed; cost: " + str(self.n_pages) + " pages checked, " + str(self.n_downloaded) + " downloaded"
+
+# Purpose: tell whether a stock passes the filter that needs only the balance sheet
+# Input: position in list_symbol
+# Output: boolean
+def passes_balancesheet (i_stock):
+    return not list_ppe_suspect [i_stock]
+
+# Purpose: tell whether a stock passes the filters that need only the Smartmoney pages
+# Input: position in list_symbol
+# Output: boolean
+def passes_smartmoney (i_stock):
+    return not (list_ppe_suspect [i_stock] or list_roe_low [i_stock] or list_iv_none [i_stock])
+
+LIST_STAGES = [
+    Stage ('Balance sheet', jobs_balancesheet, passes_balancesheet),
+    Stage ('Income and cash flow', jobs_income_cashflow, passes_smartmoney),
+    Stage ('Yahoo Finance cross-checks', jobs_stock_yahoo, None),
+]
+
+# Purpose: get the download priority of a stage's pages after the first stage
+# The later a stage, the sooner its pages are downloaded, so that the candidates are finished first.
+# Input: stage number (position in LIST_STAGES)
+# Output: priority (lower than that of any stock in the first stage)
+def priority_stage (i_stage):
+    return (-1 - i_stage,)
+
+# PAGE VALIDATION
+# Every statement page is checked before it is saved (see PAGE VALIDATION in pages.py).
+
+# CACHE SIZE
+# At the end of each run, screen-downloads is trimmed to CACHE_MB_MAX megabytes and CACHE_ENTRIES_MAX stocks
+# (see CACHE SIZE in pagestore.py): the stocks no longer in any exchange list go first (long version only; a stock
+# still listed but ruled out by the exchange lists stage does not count as delisted), then the stocks that have gone
+# unused the longest.
+CACHE_MB_MAX = 2048
+CACHE_ENTRIES_MAX = 10000
+
+# PAGE DATABASE
+# With USE_PAGE_DATABASE, the pages and parsed data of all stocks are kept in one SQLite database
+# (screen-downloads/pages.sqlite) rather than in a directory of small files for each stock.
+# The local_* paths above still name the pages (see PAGE DATABASE in pagestore.py), and pages saved as files
+# before the switch are still read until they are downloaded again.
+USE_PAGE_DATABASE = True
+
+# SEC ARCHIVES
+# With --sec-archive, the figures otherwise parsed from the Smartmoney pages (PART 7) are read from SEC
+# "Financial Statement Data Sets" archives on local disk, in one pass over each archive (see secdata.py).
+# The archives are published every quarter; give the last few years of them to cover all 5 fiscal years.
+# The Smartmoney pages of the stocks found in the archives are not downloaded.  A stock missing from the archives,
+# or missing any of the figures used, is screened from its Smartmoney pages as before.
+# The Yahoo Finance cross-checks are unchanged.
+# The stock symbol of each company comes from FILE_SEC_TICKERS (the SEC's list of symbols and CIK numbers,
+# https://www.sec.gov/include/ticker.txt) if it is in screen-input, otherwise from the names in the archive.
+# screen-input/sec-fsds-test.zip is a small sample archive with made-up figures for a few stocks of the test group.
+FILE_SEC_TICKERS = dir_input + '/sec-tickers.txt'
+dict_sec = {} # Symbol -> figures read from the archives
+if args.sec_archive != None:
+    file_tickers = None
+    if os.path.exists (FILE_SEC_TICKERS):
+        file_tickers = FILE_SEC_TICKERS
+    dict_sec, str_sec = secdata.read_archives (args.sec_archive, set (list_symbol), file_tickers)
+    print str_sec
+
+# The settings of the downloads (threads, per-host limits, page format, pages known not to exist) are shared with
+# loadtest.py, in fetch.py (see DOWNLOAD STAGE there).
+
+# Maximum number of stocks downloaded but not yet analyzed
+# The downloads pause when PART 7 falls this far behind.
+N_QUEUE_ANALYZE = 50
+
+# The downloads start here and run in the background while PART 7 analyzes each stock as soon as its pages arrive.
+# A symbol listed more than once is only downloaded once.
+# If the previous run was interrupted, its journal is used to skip the pages it already finished.
+# The stocks are downloaded in the order set by priority_stock (see DOWNLOAD ORDER above).
 create_dir (LOCAL_BASE) # Create screen-downloads directory if it does not already exist
+if USE_PAGE_DATABASE:
+    pagestore.open_store (LOCAL_BASE)
+queue_analyze = Queue.Queue (N_QUEUE_ANALYZE)
+downloader, journal, negative_cache = fetch.download_stage (LOCAL_BASE, queue_analyze, validate_page, deadline, HOURS_REFRESH_DEFAULT)
+dict_results_prev = results_previous ()
+set_carryover = read_carryover ()
+dict_i_stock = {} # Symbol -> list of positions in list_symbol
+dict_n_priority = {} # Number of filters failed -> number of stocks
 i_stock = 0
-i_stock_max = len (list_symbol)
-start = time.time ()
 for symbol in list_symbol:
-    create_dir (local_root (symbol)) # Create directory for stock if it does not already exist
-    max_age_hours = 168
-    download_data_stock (symbol, max_age_hours)
+    if not (symbol in dict_i_stock):
+        dict_i_stock [symbol] = []
+        pagestore.touch_entry (local_root (symbol)) # Mark the stock's pages as used (see CACHE SIZE)
+        priority = priority_stock (symbol, list_name [i_stock], dict_results_prev, set_carryover)
+        downloader.add (symbol, LIST_STAGES [0].jobs (symbol, refresh_hours (symbol)), priority)
+        dict_n_priority [priority [0]] = dict_n_priority.get (priority [0], 0) + 1
+    dict_i_stock [symbol].append (i_stock)
     i_stock = i_stock + 1
-
-    now = time.time ()
-    t_elapsed = now - start
-    try:
-        rate_s = i_stock / t_elapsed # Stocks/second
-        remain_s = (i_stock_max - i_stock)/rate_s
-        remain_m = int (round(remain_s/60))
-        print "Download completion: " + str(i_stock) + '/' + str(i_stock_max) + "; Minutes remaining: " + str(remain_m)
-    except:
-        pass
+print "Downloading data on " + str(len (dict_i_stock)) + " stocks"
+print "Download order: " + str(dict_n_priority.get (-1, 0)) + " carried over, " + str(dict_n_priority.get (0, 0)) + " passed last time, " + str(dict_n_priority.get (1, 0)) + " failed 1 filter, " + str(dict_n_priority.get (N_FLAGS_LAST, 0)) + " fund-like or without data (last)"
+downloader.start ()
 
     
 ###############################################################
@@ -655,24 +993,36 @@ def clean_list (list_input):
         n = n + 1            
     return list_output
 
-# Purpose: Determine the units in the page (thousands of dollars or millions of dollars)
-# Input: string
-# Output: number
-def get_units (string_html):
-    str_thousands = "Figures in thousands of U.S. Dollars"
-    str_thousands_alt = "All numbers in thousands" # Yahoo
-    str_millions = "Figures in millions of U.S. Dollars"
-    str_millions_alt = "All numbers in millions" # Yahoo
-    str_billions = "Figures in billions of U.S. Dollars"
-    str_billions_alt = "All numbers in billions" # Yahoo
-    if (str_thousands in string_html) or (str_thousands_alt in string_html):
-        return 1E3
-    elif (str_millions in string_html) or (str_millions_alt in string_html):
-        return 1E6
-    elif (str_billions in string_html) or (str_billions_alt in string_html):
-        return 1E9
-    else:
+# Purpose: Determine the end of the latest fiscal year covered by a statement page
+# The column headings are either dates (12/31/2012) or years (2012); for years, the last month of the fiscal year
+# comes from the "Fiscal year is January-December" note, or December if there is no such note.
+# Inputs: parsed page (lxml), string
+# Output: string (YYYY-MM-DD) or None
+def get_fy_end (doc, string_html):
+    list_heading = doc.xpath (u'.//th//text()')
+    list_dates = []
+    list_years = []
+    for heading in list_heading:
+        heading = heading.strip ()
+        match = re.match (r'^(\d{1,2})/(\d{1,2})/(\d{4})$', heading)
+        if match:
+            list_dates.append (datetime.date (int (match.group (3)), int (match.group (1)), int (match.group (2))))
+        elif re.match (r'^(19|20)\d\d$', heading):
+            list_years.append (int (heading))
+    if len (list_dates) > 0:
+        return max (list_dates).isoformat ()
+    if len (list_years) == 0:
         return None
+    month = 12
+    match = re.search (r'Fiscal year is \w+-(\w+)', string_html)
+    if match:
+        try:
+            month = datetime.datetime.strptime (match.group (1) [0:3], '%b').month
+        except ValueError:
+            pass
+    year = max (list_years)
+    day = calendar.monthrange (year, month) [1]
+    return datetime.date (year, month, day).isoformat ()
 
 # Purpose: Determine the dB value of a positive number
 # Input: number
@@ -737,42 +1087,47 @@ def std_dev (list_input):
         num_output = None
     return num_output
 
-list_roe_ave = []
-list_roe0 = []
-list_roe1 = []
-list_roe2 = []
-list_roe3 = []
-list_eps = []
-list_netliq_ps = []
-list_intrinsic_ps = []
-list_pe = []
-list_yield = []
-list_pb = []
-list_assets_smartmoney = []
-list_assets_yahoo = []
-list_assets_ratio = []
-list_assets_suspect = []
-list_rev_smartmoney = []
-list_rev_yahoo = []
-list_rev_ratio = []
-list_rev_suspect = []
-list_ppe_growth = []
-list_ppe_growth_dev = []
-list_ppe_suspect = []
-list_roe_dev = []
-list_roe_lowball = []
-list_roe_low = []
-list_iv_none = []
-
-i_stock = 0
-i_stock_max = len (list_symbol)
-start = time.time ()
-for symbol in list_symbol:
-    print "Analyzing " + symbol
-
+list_roe_ave = [None] * num_stocks
+list_roe0 = [None] * num_stocks
+list_roe1 = [None] * num_stocks
+list_roe2 = [None] * num_stocks
+list_roe3 = [None] * num_stocks
+list_eps = [None] * num_stocks
+list_netliq_ps = [None] * num_stocks
+list_intrinsic_ps = [None] * num_stocks
+list_pe = [None] * num_stocks
+list_yield = [None] * num_stocks
+list_pb = [None] * num_stocks
+list_assets_smartmoney = [None] * num_stocks
+list_assets_yahoo = [None] * num_stocks
+list_assets_ratio = [None] * num_stocks
+list_assets_suspect = [None] * num_stocks
+list_rev_smartmoney = [None] * num_stocks
+list_rev_yahoo = [None] * num_stocks
+list_rev_ratio = [None] * num_stocks
+list_rev_suspect = [None] * num_stocks
+list_ppe_growth = [None] * num_stocks
+list_ppe_growth_dev = [None] * num_stocks
+list_ppe_suspect = [None] * num_stocks
+list_roe_dev = [None] * num_stocks
+list_roe_lowball = [None] * num_stocks
+list_roe_low = [None] * num_stocks
+list_iv_none = [None] * num_stocks
+
+# Purpose: get the contents of a page, using the downloaded copy if there is one
+# Inputs: local file, dict of local file -> contents (None if the page was not downloaded in this run)
+# Output: string
+def read_page (file_name, dict_html):
+    contents = dict_html.get (file_name)
+    if contents == None:
+        contents = pagestore.read_page (file_name)
+    return contents
+
+# Purpose: parse the financial data in a stock's Smartmoney balance sheet
+# Inputs: stock symbol, dict of local file -> contents
+# Output: dict of the lists of figures and their units
+def parse_balancesheet (symbol, dict_html):
     # SPECIAL THANKS to root on stackoverflow.com for help on how to parse a row from the Smartmoney pages.
-    # SPECIAL THANKS to MRAB on comp.lang.python and soulseekah on stackoverflow.com for help on how to parse a 
-    # row from the Yahoo Finance pages.
 
     # PARSE DATA FROM BALANCE SHEET
     list_cash = []
@@ -781,15 +1136,14 @@ for symbol in list_symbol:
     list_ps = []
     list_assets = []
     units_balancesheet = 0
+    fy_end = None
 
     try:
-        url_local = local_balancesheet (symbol)
-        url_local = "file://" + url_local
-        result = urllib.urlopen(url_local)
-        element_html = result.read()
+        element_html = read_page (local_balancesheet (symbol), dict_html)
         doc = lxml.html.document_fromstring (element_html)
 
         units_balancesheet = get_units (element_html)
+        fy_end = get_fy_end (doc, element_html)
 
         list_row = doc.xpath(u'.//th[div[contains (text(), "Cash & Short Term Investments")]]/following-sibling::td/text()')
         list_cash = clean_list (list_row)
@@ -809,33 +1163,26 @@ for symbol in list_symbol:
     except:
         print "Balance sheet data not found"
 
-    # PARSE DATA FROM BALANCE SHEET (YAHOO)
-    list_assets_alt = []
-    units_balancesheet_alt = 0
-    try:
-        url_local = local_balancesheet_yahoo (symbol)
-        url_local = "file://" + url_local
-        result = urllib.urlopen(url_local)
-        element_html = result.read()
-        doc = lxml.html.document_fromstring (element_html)
-
-        units_balancesheet_alt = get_units (element_html)
-
-        list_row = doc.xpath(u'.//td[strong[contains (text(),"Total Assets")]]/following-sibling::td/strong/text()') 
-        list_assets_alt = clean_list (list_row)
-
-    except:
-        print "Yahoo Finance balance sheet data not found"
-
+    dict_fields = {}
+    dict_fields ['list_cash'] = list_cash
+    dict_fields ['list_ppe'] = list_ppe
+    dict_fields ['list_liab'] = list_liab
+    dict_fields ['list_ps'] = list_ps
+    dict_fields ['list_assets'] = list_assets
+    dict_fields ['units_balancesheet'] = units_balancesheet
+    dict_fields ['fy_end'] = fy_end
+    return dict_fields
+
+# Purpose: parse the financial data in a stock's Smartmoney cash flow statement
+# Inputs: stock symbol, dict of local file -> contents
+# Output: dict of the lists of figures and their units
+def parse_cashflow (symbol, dict_html):
     # PARSE DATA FROM CASH FLOW STATEMENT
     list_cfo = [] # Cash flow from operations
     units_cashflow = 0
     
     try:
-        url_local = local_cashflow (symbol)
-        url_local = "file://" + url_local
-        result = urllib.urlopen(url_local)
-        element_html = result.read()
+        element_html = read_page (local_cashflow (symbol), dict_html)
         doc = lxml.html.document_fromstring (element_html)
 
         units_cashflow = get_units (element_html)
@@ -845,16 +1192,22 @@ for symbol in list_symbol:
     except:
         print "Cash flow data not found"
 
+    dict_fields = {}
+    dict_fields ['list_cfo'] = list_cfo
+    dict_fields ['units_cashflow'] = units_cashflow
+    return dict_fields
+
+# Purpose: parse the financial data in a stock's Smartmoney income statement
+# Inputs: stock symbol, dict of local file -> contents
+# Output: dict of the lists of figures and their units
+def parse_income (symbol, dict_html):
     # PARSE DATA FROM INCOME STATEMENT
     list_tax = [] # Income tax expense
     list_rev = [] # Revenue
     units_income = 0
     
     try:
-        url_local = local_income (symbol)
-        url_local = "file://" + url_local
-        result = urllib.urlopen(url_local)
-        element_html = result.read()
+        element_html = read_page (local_income (symbol), dict_html)
         doc = lxml.html.document_fromstring (element_html)
 
         units_income = get_units (element_html)
@@ -867,14 +1220,48 @@ for symbol in list_symbol:
     except:
         print "Income statement data not found"
 
+    dict_fields = {}
+    dict_fields ['list_tax'] = list_tax
+    dict_fields ['list_rev'] = list_rev
+    dict_fields ['units_income'] = units_income
+    return dict_fields
+
+# SPECIAL THANKS to MRAB on comp.lang.python and soulseekah on stackoverflow.com for help on how to parse a 
+# row from the Yahoo Finance pages.
+
+# Purpose: parse the financial data in a stock's Yahoo Finance balance sheet
+# Inputs: stock symbol, dict of local file -> contents
+# Output: dict of the lists of figures and their units
+def parse_balancesheet_yahoo (symbol, dict_html):
+    # PARSE DATA FROM BALANCE SHEET (YAHOO)
+    list_assets_alt = []
+    units_balancesheet_alt = 0
+    try:
+        element_html = read_page (local_balancesheet_yahoo (symbol), dict_html)
+        doc = lxml.html.document_fromstring (element_html)
+
+        units_balancesheet_alt = get_units (element_html)
+
+        list_row = doc.xpath(u'.//td[strong[contains (text(),"Total Assets")]]/following-sibling::td/strong/text()') 
+        list_assets_alt = clean_list (list_row)
+
+    except:
+        print "Yahoo Finance balance sheet data not found"
+
+    dict_fields = {}
+    dict_fields ['list_assets_alt'] = list_assets_alt
+    dict_fields ['units_balancesheet_alt'] = units_balancesheet_alt
+    return dict_fields
+
+# Purpose: parse the financial data in a stock's Yahoo Finance income statement
+# Inputs: stock symbol, dict of local file -> contents
+# Output: dict of the lists of figures and their units
+def parse_income_yahoo (symbol, dict_html):
     # PARSE DATA FROM INCOME SHEET (YAHOO)
     list_rev_alt = []
-    units_rev_alt = 0
+    units_income_alt = 0
     try:
-        url_local = local_income_yahoo (symbol)
-        url_local = "file://" + url_local
-        result = urllib.urlopen(url_local)
-        element_html = result.read()
+        element_html = read_page (local_income_yahoo (symbol), dict_html)
         doc = lxml.html.document_fromstring (element_html)
 
         units_income_alt = get_units (element_html)
@@ -885,6 +1272,109 @@ for symbol in list_symbol:
     except:
         print "Yahoo Finance balance sheet data not found"
 
+    dict_fields = {}
+    dict_fields ['list_rev_alt'] = list_rev_alt
+    dict_fields ['units_income_alt'] = units_income_alt
+    return dict_fields
+
+# Purpose: get a stock's figures from the SEC archives (see SEC ARCHIVES in PART 6)
+# Inputs: stock symbol, dict of local file -> contents (not used)
+# Output: dict of the lists of figures and their units
+def parse_sec (symbol, dict_html):
+    return dict (dict_sec [symbol])
+
+# Pages parsed for a stock: function giving the local file -> parser
+# The figures of each page are kept in the parse cache on their own (see fields_stock), so a page parsed at one stage
+# of the SCREENING FUNNEL is not parsed again when a later stage's pages arrive.
+LIST_PARSERS_SMARTMONEY = [
+    (local_balancesheet, parse_balancesheet),
+    (local_cashflow, parse_cashflow),
+    (local_income, parse_income),
+]
+LIST_PARSERS_YAHOO = [
+    (local_balancesheet_yahoo, parse_balancesheet_yahoo),
+    (local_income_yahoo, parse_income_yahoo),
+]
+
+# Purpose: get the parts of a stock's data, each with the content hash it is parsed from
+# The figures read from the SEC archives (see SEC ARCHIVES in PART 6), if any, take the place of the Smartmoney pages.
+# Inputs: stock symbol, dict of local file -> contents (None if the page was not downloaded in this run)
+# Output: list of (name of the part: page file name or 'sec', SHA-1 (None for a missing page), parser)
+def parts_stock (symbol, dict_html):
+    list_parts = []
+    if symbol in dict_sec:
+        list_parts.append (('sec', pagestore.digest (json.dumps (dict_sec [symbol], sort_keys = True)), parse_sec))
+        list_parsers = LIST_PARSERS_YAHOO
+    else:
+        list_parsers = LIST_PARSERS_SMARTMONEY + LIST_PARSERS_YAHOO
+    for local_page, parser in list_parsers:
+        file_name = local_page (symbol)
+        contents = dict_html.get (file_name)
+        if contents != None:
+            sha1 = pagestore.digest (contents)
+        else:
+            sha1 = pagestore.page_digest (file_name)
+        list_parts.append ((os.path.basename (file_name), sha1, parser))
+    return list_parts
+
+# Version of the data saved by fields_stock; increase it whenever a parser changes, so that the pages are parsed again
+FIELDS_VERSION = 3
+
+# Purpose: get the financial data of a stock, parsing only the pages that have changed since they were last parsed
+# The parse cache (local_fields) keeps the figures of each page along with the content hash of that page.
+# Inputs: stock symbol, dict of local file -> contents
+# Output: dict of the lists of figures and their units
+def fields_stock (symbol, dict_html):
+    dict_saved_parts = {}
+    try:
+        dict_saved = json.loads (pagestore.read_page (local_fields (symbol)))
+        if dict_saved ['version'] == FIELDS_VERSION:
+            dict_saved_parts = dict_saved ['parts']
+    except:
+        pass
+    dict_fields = {}
+    dict_parts = {}
+    n_parsed = 0
+    for name, sha1, parser in parts_stock (symbol, dict_html):
+        saved = dict_saved_parts.get (name)
+        if saved != None and saved ['digest'] == sha1:
+            dict_part = saved ['fields']
+        else:
+            dict_part = parser (symbol, dict_html)
+            n_parsed = n_parsed + 1
+        dict_parts [name] = {'digest': sha1, 'fields': dict_part}
+        dict_fields.update (dict_part)
+    if n_parsed == 0:
+        print "Pages unchanged - reusing parsed data"
+        return dict_fields
+    try:
+        str_saved = json.dumps ({'version': FIELDS_VERSION, 'parts': dict_parts})
+        pagestore.write_page (local_fields (symbol), str_saved, pagestore.FORMAT_PLAIN)
+    except:
+        print "Could not save parsed data"
+    return dict_fields
+
+# Purpose: compute the Dopeler figures of a stock
+# Inputs: position in list_symbol, stock symbol, dict of local file -> contents
+def analyze_stock (i_stock, symbol, dict_html):
+    print "Analyzing " + symbol
+
+    dict_fields = fields_stock (symbol, dict_html)
+    list_cash = dict_fields ['list_cash']
+    list_ppe = dict_fields ['list_ppe']
+    list_liab = dict_fields ['list_liab']
+    list_ps = dict_fields ['list_ps']
+    list_assets = dict_fields ['list_assets']
+    units_balancesheet = dict_fields ['units_balancesheet']
+    list_assets_alt = dict_fields ['list_assets_alt']
+    units_balancesheet_alt = dict_fields ['units_balancesheet_alt']
+    list_cfo = dict_fields ['list_cfo']
+    units_cashflow = dict_fields ['units_cashflow']
+    list_tax = dict_fields ['list_tax']
+    list_rev = dict_fields ['list_rev']
+    units_income = dict_fields ['units_income']
+    list_rev_alt = dict_fields ['list_rev_alt']
+    units_income_alt = dict_fields ['units_income_alt']
 
     # last year's PPE (at end of year) = PPE at the start of this year
     # this year's pre-tax free cash flow = This year's after-tax free cash flow + this year's income taxes
@@ -1013,11 +1503,11 @@ for symbol in list_symbol:
     except:
         roe_ave = None
                 
-    list_roe_ave.append (roe_ave)
-    list_roe0.append (roe0)
-    list_roe1.append (roe1)
-    list_roe2.append (roe2)
-    list_roe3.append (roe3)
+    list_roe_ave [i_stock] = roe_ave
+    list_roe0 [i_stock] = roe0
+    list_roe1 [i_stock] = roe1
+    list_roe2 [i_stock] = roe2
+    list_roe3 [i_stock] = roe3
 
     # this year's projected Dopeler Earnings = last year's PPE * average Dopeler Return On Equity for the last 4 years
     earn = 0
@@ -1044,7 +1534,7 @@ for symbol in list_symbol:
         earn_ps = earn / nshares
     except:
         earn_ps = None
-    list_eps.append (earn_ps)
+    list_eps [i_stock] = earn_ps
 
     # Net liquidity per share
     netliqps = 0
@@ -1052,7 +1542,7 @@ for symbol in list_symbol:
         netliqps = netliq / nshares
     except:
         netliqps = None
-    list_netliq_ps.append (netliqps)
+    list_netliq_ps [i_stock] = netliqps
 
     # Intrinsic value per share
     intrinsic_ps = 0
@@ -1060,7 +1550,7 @@ for symbol in list_symbol:
         intrinsic_ps = 10 * earn_ps + netliqps
     except:
         intrinsic_ps = None
-    list_intrinsic_ps.append (intrinsic_ps)
+    list_intrinsic_ps [i_stock] = intrinsic_ps
 
     # Price
     price = list_price [i_stock]
@@ -1073,7 +1563,7 @@ for symbol in list_symbol:
             pb = None
     except:
         pb = None
-    list_pb.append (pb)
+    list_pb [i_stock] = pb
 
     # Dopeler PE
     pe = 0
@@ -1083,7 +1573,7 @@ for symbol in list_symbol:
             pe = None
     except:
         pe = None
-    list_pe.append (pe)
+    list_pe [i_stock] = pe
 
     # Dopeler Yield
     yld = 0
@@ -1093,7 +1583,7 @@ for symbol in list_symbol:
             yld = None
     except:
          yld = None
-    list_yield.append (yld)
+    list_yield [i_stock] = yld
 
 
     ########################################################################
@@ -1106,27 +1596,27 @@ for symbol in list_symbol:
         assets0 = list_assets[0] * units_balancesheet / 1E9
     except:
         assets0 = None
-    list_assets_smartmoney.append (assets0)
+    list_assets_smartmoney [i_stock] = assets0
 
     assets0_alt = 0
     try:
         assets0_alt = list_assets_alt[0] * units_balancesheet_alt / 1E9
     except:
         assets0_alt = None
-    list_assets_yahoo.append (assets0_alt)
+    list_assets_yahoo [i_stock] = assets0_alt
 
     assets_ratio = 0
     try:
         assets_ratio = abs (db (assets0 / assets0_alt)) # dB
     except:
         assets_ratio = None
-    list_assets_ratio.append (assets_ratio)
+    list_assets_ratio [i_stock] = assets_ratio
 
     # If the Smartmoney and the Yahoo Finance asset figures differ by 2 dB or more, suspect bad data.
     assets_suspect = False
     if assets_ratio >= 2 or assets_ratio == None:
         assets_suspect = True
-    list_assets_suspect.append (assets_suspect)
+    list_assets_suspect [i_stock] = assets_suspect
 
     # Check for revenue difference between Smartmoney and Yahoo Finance
     rev0 = 0
@@ -1134,27 +1624,27 @@ for symbol in list_symbol:
         rev0 = list_rev[0] * units_income / 1E9
     except:
         rev0 = None
-    list_rev_smartmoney.append (rev0)
+    list_rev_smartmoney [i_stock] = rev0
 
     rev0_alt = 0
     try:
         rev0_alt = list_rev_alt[0] * units_income_alt / 1E9
     except:
         rev0_alt = None
-    list_rev_yahoo.append (rev0_alt)
+    list_rev_yahoo [i_stock] = rev0_alt
 
     rev_ratio = 0
     try:
         rev_ratio = abs (db (rev0 / rev0_alt)) # dB
     except:
         rev_ratio = None
-    list_rev_ratio.append (rev_ratio)
+    list_rev_ratio [i_stock] = rev_ratio
 
     # If the Smartmoney and the Yahoo Finance revenue figures differ by 2 dB or more, suspect bad data.
     rev_suspect = False
     if rev_ratio >= 2 or rev_ratio == None:
         rev_suspect = True
-    list_rev_suspect.append (rev_suspect)
+    list_rev_suspect [i_stock] = rev_suspect
     
     ppe0_db = 0
     ppe1_db = 0
@@ -1172,14 +1662,14 @@ for symbol in list_symbol:
     except:
         ppe_growth = None
         ppe_growth_dev = None
-    list_ppe_growth.append (ppe_growth)
-    list_ppe_growth_dev.append (ppe_growth_dev)
+    list_ppe_growth [i_stock] = ppe_growth
+    list_ppe_growth_dev [i_stock] = ppe_growth_dev
 
     # If the standard deviation of the PPE growth is at least 1 dB, suspect bad data.
     ppe_suspect = False
     if ppe_growth_dev >= 1 or ppe_growth_dev == None:
         ppe_suspect = True
-    list_ppe_suspect.append (ppe_suspect)
+    list_ppe_suspect [i_stock] = ppe_suspect
 
     # Get relative standard deviation of Dopeler ROE
     roe_dev = 0
@@ -1188,7 +1678,7 @@ for symbol in list_symbol:
         roe_dev = abs (roe_dev)
     except:
         roe_dev = None
-    list_roe_dev.append (roe_dev)
+    list_roe_dev [i_stock] = roe_dev
 
     # Get lowest Dopeler ROE
     roe_min = 0
@@ -1217,22 +1707,58 @@ for symbol in list_symbol:
         roe_lowball = max (roe_min, roe_ave - roe_dev)
     except:
         roe_lowball = None
-    list_roe_lowball.append (roe_lowball)
+    list_roe_lowball [i_stock] = roe_lowball
 
     # If the lowball Dopeler ROE is under 10%, this is too low to be compatible with Doppler Value Investing.
     # to be compatible with Doppler Value Investing.
     roe_low = False
     if roe_lowball <.1 or roe_lowball == None:
         roe_low = True
-    list_roe_low.append (roe_low)
+    list_roe_low [i_stock] = roe_low
 
     # If there is no intrinsic value or negative intrinsic value, this stock is not compatible with Doppler
     # Value Investing.
     iv_none = False
     if intrinsic_ps <=0 or intrinsic_ps == None:
         iv_none = True
-    list_iv_none.append (iv_none)
-
+    list_iv_none [i_stock] = iv_none
+
+# Purpose: mark the cross-checks of a stock removed before the last stage as not done when it has no
+# Yahoo Finance data (see SCREENING FUNNEL in PART 6)
+# Input: position in list_symbol
+def skip_cross_check (i_stock):
+    if list_assets_yahoo [i_stock] == None:
+        list_assets_suspect [i_stock] = None
+    if list_rev_yahoo [i_stock] == None:
+        list_rev_suspect [i_stock] = None
+
+# Analyze each stock as soon as the pages of a stage have been downloaded, then move it on to the next stage
+i_stock = 0
+i_stock_max = len (dict_i_stock)
+dict_stage = {} # Symbol -> stage it is in (position in LIST_STAGES), for the stocks past the first stage
+start = time.time ()
+while i_stock < i_stock_max:
+    symbol, dict_html = queue_analyze.get ()
+    for i_symbol in dict_i_stock [symbol]:
+        analyze_stock (i_symbol, symbol, dict_html)
+    i_stage = dict_stage.get (symbol, 0)
+    stage = LIST_STAGES [i_stage]
+    stage.n_in = stage.n_in + 1
+    stage.n_pages = stage.n_pages + len (dict_html)
+    for contents in dict_html.values ():
+        if contents != None:
+            stage.n_downloaded = stage.n_downloaded + 1
+    if stage.test == None:
+        pass # Last stage
+    elif stage.test (dict_i_stock [symbol][0]):
+        dict_stage [symbol] = i_stage + 1
+        stage_next = LIST_STAGES [i_stage + 1]
+        downloader.add (symbol, stage_next.jobs (symbol, refresh_hours (symbol)), priority_stage (i_stage + 1))
+        i_stock_max = i_stock_max + 1
+    else:
+        stage.n_removed = stage.n_removed + 1
+        for i_symbol in dict_i_stock [symbol]:
+            skip_cross_check (i_symbol)
 
     i_stock = i_stock + 1
     now = time.time ()
@@ -1241,6 +1767,35 @@ for symbol in list_symbol:
     remain_s = (i_stock_max - i_stock)/rate_s
     remain_m = int (round(remain_s/60))
     print "Analysis completion: " + str(i_stock) + '/' + str(i_stock_max) + "; Minutes remaining: " + str(remain_m)
+downloader.join ()
+for stage in LIST_STAGES:
+    print stage.stats ()
+if args.offline:
+    print fetch.offline_stats ()
+else:
+    journal.finish ()
+    write_carryover (downloader.list_skipped)
+    if downloader.list_skipped != []:
+        print "Deadline reached: " + str(len (downloader.list_skipped)) + " stocks analyzed from saved pages and carried over to the next run"
+    negative_cache.save ()
+    print fetch.pool.stats ()
+    print fetch.transfer_stats ()
+    print fetch.breaker.stats ()
+    print fetch.retry_stats ()
+    print fetch.rates.stats ()
+    print downloader.latency_stats ()
+    print negative_cache.stats ()
+    print fetch.flights.stats ()
+    print fetch.invalid_stats ()
+    if fetch.pacer != None:
+        print fetch.pacer.stats ()
+    set_keep = None
+    if run_long:
+        set_keep = set_symbol_listed
+    n_removed, n_bytes_freed = pagestore.evict (LOCAL_BASE, CACHE_MB_MAX * 1048576, CACHE_ENTRIES_MAX, set_keep)
+    print "Cache trimmed: " + str(n_removed) + " stocks removed, " + '{0:.1f}'.format (n_bytes_freed / 1048576.0) + " MB freed"
+    print pagestore.cache_stats (LOCAL_BASE)
+    fetch.rates.save (os.path.join (LOCAL_BASE, fetch.FILE_RATES))
 
 ######################################################################
 # PART 8: CREATE A CLASS TO STORE EACH STOCK AND ITS OUTPUT PARAMETERS
@@ -0,0 +1,227 @@
+#! /usr/bin/python
+
+# This module reads the financial figures used by screen.py from SEC "Financial Statement Data Sets" archives
+# (https://www.sec.gov/dera/data/financial-statement-data-sets), instead of from one Smartmoney page per statement
+# and stock.  Each archive is a zip file holding tab-separated tables, of which two are used:
+# sub.txt: one row for each filing (accession number, CIK, form, fiscal period, date filed, XBRL instance name)
+# num.txt: one row for each figure (accession number, tag, tag version, date, number of quarters, units, value)
+# The tags are the standard us-gaap ones, so tag.txt is not needed: num.txt gives the accession number as the version
+# of a tag defined by the company itself, and such tags are ignored.
+# Only the annual reports (FORMS_ANNUAL, fiscal period FY) of the stocks asked for are kept, and num.txt is read
+# in one sequential pass, keeping only the rows of the tags in DICT_FIELD_TAGS.
+# The figures end up in the same form as those parsed from the Smartmoney pages by screen.py (PART 7): one list for
+# each field, most recent fiscal year first, in U.S. dollars (units of 1).
+# When several archives are read (for example the last few years of quarterly archives), a figure reported again in
+# a later filing (a restatement) replaces the earlier one.
+#
+# The stock symbol of a filing comes from a list of symbols and CIK numbers (symbol<TAB>CIK, as in the SEC's
+# ticker.txt) if one is given, otherwise from the name of its XBRL instance (ko-20121231.xml -> KO).
+#
+# screen-input/sec-fsds-test.zip is a small sample archive in this format, with made-up figures for a few of the
+# stocks of the test group (see companylist-test.csv).
+#
+# Usage from the command line:
+# python secdata.py ARCHIVE [ARCHIVE ...]
+
+import sys
+import zipfile
+import datetime
+
+FORMS_ANNUAL = ['10-K', '10-K/A', '10-KT', '20-F', '40-F']
+N_YEARS = 5 # Number of fiscal years kept for each field (as many as on the Smartmoney pages)
+
+# Tags for each field, most preferred first; for each date, the first tag with a value is used
+# Smartmoney's "Cash & Short Term Investments" is matched by the first cash tag; companies that do not report that
+# total only have their cash and cash equivalents counted.
+DICT_FIELD_TAGS = {
+    'list_cash': ['CashCashEquivalentsAndShortTermInvestments', 'CashAndCashEquivalentsAtCarryingValue', 'Cash'],
+    'list_ppe': ['PropertyPlantAndEquipmentGross'],
+    'list_liab': ['Liabilities'],
+    'list_ps': ['PreferredStockValue', 'PreferredStockValueOutstanding'],
+    'list_assets': ['Assets'],
+    'list_cfo': ['NetCashProvidedByUsedInOperatingActivities', 'NetCashProvidedByUsedInOperatingActivitiesContinuingOperations'],
+    'list_tax': ['IncomeTaxExpenseBenefit'],
+    'list_rev': ['Revenues', 'SalesRevenueNet', 'RevenueFromContractWithCustomerExcludingAssessedTax'],
+}
+
+# Fields reported for a whole fiscal year (4 quarters); the others are balances at the end of the year (0 quarters)
+LIST_FIELDS_DURATION = ['list_cfo', 'list_tax', 'list_rev']
+
+# Fields that may be missing altogether (a company without preferred stock does not report any)
+# They count as 0 for every year.  A stock missing any other field is left out, so that its Smartmoney pages are
+# used instead.
+LIST_FIELDS_OPTIONAL = ['list_ps']
+
+# Tag -> field
+DICT_TAG_FIELD = {}
+for field in DICT_FIELD_TAGS:
+    for tag in DICT_FIELD_TAGS [field]:
+        DICT_TAG_FIELD [tag] = field
+
+# Purpose: read the rows of a table in an archive, one at a time
+# Inputs: zipfile.ZipFile, name of the table (sub.txt or num.txt), list of column titles
+# Output: iterator of lists of strings (the values of those columns; '' for a column the table does not have)
+def table_rows (archive, name, list_titles):
+    f = archive.open (name)
+    try:
+        list_header = f.readline ().rstrip ('\r\n').split ('\t')
+        list_n = []
+        for title in list_titles:
+            if title in list_header:
+                list_n.append (list_header.index (title))
+            else:
+                list_n.append (None)
+        for line in f:
+            list_line = line.rstrip ('\r\n').split ('\t')
+            list_row = []
+            for n in list_n:
+                if n == None or n >= len (list_line):
+                    list_row.append ('')
+                else:
+                    list_row.append (list_line [n])
+            yield list_row
+    finally:
+        f.close ()
+
+# Purpose: read a list of stock symbols and their CIK numbers (the SEC's ticker.txt)
+# Input: file name
+# Output: dict of CIK (string, without leading zeros) -> list of stock symbols
+def read_tickers (file_name):
+    dict_cik_symbols = {}
+    with open (file_name, 'r') as f:
+        for line in f:
+            list_line = line.split ()
+            if len (list_line) != 2:
+                continue
+            symbol = list_line [0].upper ()
+            cik = list_line [1].lstrip ('0')
+            dict_cik_symbols.setdefault (cik, []).append (symbol)
+    return dict_cik_symbols
+
+# Purpose: get the stock symbols of a filing
+# Inputs: CIK, name of the XBRL instance, dict from read_tickers (None if there is no list of symbols)
+# Output: list of stock symbols
+def filing_symbols (cik, instance, dict_cik_symbols):
+    if dict_cik_symbols != None:
+        return dict_cik_symbols.get (cik.lstrip ('0'), [])
+    if not ('-' in instance):
+        return []
+    return [instance.split ('-') [0].upper ()]
+
+# Purpose: read the figures of the annual reports in an archive
+# Inputs: archive file name, set of stock symbols wanted (None for all), dict from read_tickers (or None),
+# dict of the figures read so far, which is updated:
+# symbol -> field -> tag -> date (YYYYMMDD) -> (date filed, value)
+# Output: (number of filings used, number of figures used)
+def read_archive (file_zip, set_symbols, dict_cik_symbols, dict_facts):
+    archive = zipfile.ZipFile (file_zip, 'r')
+    try:
+        # Annual reports of the stocks wanted
+        dict_filing = {} # Accession number -> (list of symbols, date filed)
+        list_titles = ['adsh', 'cik', 'form', 'fp', 'filed', 'instance']
+        for adsh, cik, form, fp, filed, instance in table_rows (archive, 'sub.txt', list_titles):
+            if not (form in FORMS_ANNUAL) or fp != 'FY':
+                continue
+            list_symbols = []
+            for symbol in filing_symbols (cik, instance, dict_cik_symbols):
+                if set_symbols == None or symbol in set_symbols:
+                    list_symbols.append (symbol)
+            if list_symbols != []:
+                dict_filing [adsh] = (list_symbols, filed)
+
+        # Their figures, in one pass
+        n_facts = 0
+        list_titles = ['adsh', 'tag', 'version', 'coreg', 'segments', 'ddate', 'qtrs', 'uom', 'value']
+        for adsh, tag, version, coreg, segments, ddate, qtrs, uom, value in table_rows (archive, 'num.txt', list_titles):
+            if not (tag in DICT_TAG_FIELD) or not (adsh in dict_filing):
+                continue
+            if version == adsh or coreg != '' or segments != '' or uom != 'USD' or value == '':
+                continue # Custom tag, figure of a subsidiary or a segment, other currency, or no value
+            field = DICT_TAG_FIELD [tag]
+            qtrs_field = '0'
+            if field in LIST_FIELDS_DURATION:
+                qtrs_field = '4'
+            if qtrs != qtrs_field:
+                continue
+            try:
+                value = float (value)
+            except ValueError:
+                continue
+            list_symbols, filed = dict_filing [adsh]
+            for symbol in list_symbols:
+                dict_dates = dict_facts.setdefault (symbol, {}).setdefault (field, {}).setdefault (tag, {})
+                if not (ddate in dict_dates) or dict_dates [ddate][0] <= filed:
+                    dict_dates [ddate] = (filed, value)
+            n_facts = n_facts + 1
+    finally:
+        archive.close ()
+    return len (dict_filing), n_facts
+
+# Purpose: put a stock's figures in the form of the data parsed from the Smartmoney pages
+# Input: dict of field -> tag -> date -> (date filed, value) (from read_archive)
+# Output: dict of the lists of figures and their units (None if a field is missing)
+def fields_from_facts (dict_fields_facts):
+    # The fiscal years are the dates for which there are figures, most recent first
+    set_dates = set ()
+    for field in dict_fields_facts:
+        for tag in dict_fields_facts [field]:
+            set_dates.update (dict_fields_facts [field][tag].keys ())
+    list_dates = sorted (set_dates, reverse = True) [0:N_YEARS]
+
+    dict_fields = {}
+    for field in DICT_FIELD_TAGS:
+        dict_tags = dict_fields_facts.get (field, {})
+        list_values = []
+        for ddate in list_dates:
+            value = None
+            for tag in DICT_FIELD_TAGS [field]:
+                if ddate in dict_tags.get (tag, {}):
+                    value = dict_tags [tag][ddate][1]
+                    break
+            if value == None and field in LIST_FIELDS_OPTIONAL:
+                value = 0.0
+            list_values.append (value)
+        if list_values == [] or list_values [0] == None:
+            return None
+        dict_fields [field] = list_values
+    dict_fields ['units_balancesheet'] = 1
+    dict_fields ['units_cashflow'] = 1
+    dict_fields ['units_income'] = 1
+    dict_fields ['fy_end'] = datetime.datetime.strptime (list_dates [0], '%Y%m%d').date ().isoformat ()
+    return dict_fields
+
+# Purpose: read the figures of the stocks wanted from one or more archives
+# Inputs: list of archive file names, set of stock symbols wanted (None for all),
+# file listing the symbol of each CIK (None to use the names of the XBRL instances)
+# Outputs: dict of symbol -> dict of the lists of figures and their units (only the stocks with every field),
+# string (what was read)
+def read_archives (list_files, set_symbols = None, file_tickers = None):
+    dict_cik_symbols = None
+    if file_tickers != None:
+        dict_cik_symbols = read_tickers (file_tickers)
+    dict_facts = {}
+    n_filings = 0
+    n_facts = 0
+    for file_zip in list_files:
+        n_filings_archive, n_facts_archive = read_archive (file_zip, set_symbols, dict_cik_symbols, dict_facts)
+        n_filings = n_filings + n_filings_archive
+        n_facts = n_facts + n_facts_archive
+    dict_output = {}
+    for symbol in dict_facts:
+        dict_fields = fields_from_facts (dict_facts [symbol])
+        if dict_fields != None:
+            dict_output [symbol] = dict_fields
+    str_stats = "SEC archives: " + str(len (list_files)) + " read, " + str(n_filings) + " annual reports, " + str(n_facts) + " figures; complete figures for " + str(len (dict_output)) + " of " + str(len (dict_facts)) + " stocks"
+    return dict_output, str_stats
+
+if __name__ == '__main__':
+    if len (sys.argv) < 2:
+        print "Usage: python secdata.py ARCHIVE [ARCHIVE ...]"
+        sys.exit (1)
+    dict_output, str_stats = read_archives (sys.argv [1:])
+    for symbol in sorted (dict_output):
+        dict_fields = dict_output [symbol]
+        print symbol + " (fiscal year ending " + dict_fields ['fy_end'] + ")"
+        for field in sorted (DICT_FIELD_TAGS):
+            print "    " + field + ": " + str(dict_fields [field])
+    print str_stats
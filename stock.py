@@ -12,6 +12,10 @@ import glob
 import re
 import math
 import operator
+import argparse
+
+import fetch
+from fetch import download_page_shared
 
 ##########################################################################################
 # PART 1: FIGURE OUT THE DIRECTORY STRUCTURE
@@ -38,72 +42,20 @@ dir_input_screen = dir_main + '/screen-input'
 dir_input_stock = dir_main + '/stock-input'
 dir_output_stock = dir_main + '/stock-output'  
 
+# OFFLINE MODE
+# With --offline, the lists of stocks already saved in screen-input are used however old they are,
+# and no connection is opened.
+parser = argparse.ArgumentParser (description = 'Doppler Value Investing stock analysis')
+parser.add_argument ('--offline', action = 'store_true', help = 'use only the pages already saved (no network access)')
+args = parser.parse_args ()
+if args.offline:
+    fetch.go_offline ()
+    print "Offline mode: using only the pages already saved"
+
 ######################################################################################
 # PART 2: DOWNLOAD THE LISTS OF AMEX, NYSE, AND NASDAQ STOCKS FROM THE NASDAQ WEB SITE
 ######################################################################################
 
-# Get age of file
-# Based on solution at 
-# http://stackoverflow.com/questions/5799070/how-to-see-if-file-is-older-than-3-months-in-python
-# Returns a billion if the file does not exist
-def age_of_file (file1): # In hours
-    now = datetime.datetime.now ()
-    try:
-        modified_date = datetime.datetime.fromtimestamp(os.path.getmtime(file1))
-        age = now - modified_date
-        age_days = age.days 
-        age_seconds = age.seconds
-        age_hours = 24 * age_days + age_seconds/3600
-        return age_hours
-    except:
-        return 1000000000
-
-class TimeoutException(Exception): 
-    pass
-
-def timeout_handler(signum, frame):
-    raise TimeoutException()
-
-# Download a page from a url and save it
-# Only download if the existing page is at least 4 days old.
-# If the download is not successful, make up to 2 additional attempts.
-# Inputs: URL of source, path of destination
-# Times out after 10 seconds
-def download_page (url, file_name, file_age_max_hours):
-    from urllib2 import Request, urlopen, URLError, HTTPError
-    file_age = age_of_file (file_name) # In hours
-    file_size = 0
-    try:
-        file_size = os.path.getsize (file_name)
-    except:
-        file_size = 0
-    n_fail = 0
-    n_fail_max = 2
-    while ((file_age > file_age_max_hours or file_size == 0) and n_fail <= n_fail_max):
-        try:
-            f = urllib2.urlopen (url)
-            local_file = open (file_name, 'w') # Open local file
-            local_file.write (f.read())
-            local_file.close ()
-            time.sleep (random.uniform (.1, .2)) # Delay is needed to limit the impact on the upstream server
-            break # Script hangs without this command
-        except urllib2.HTTPError, e:
-            n_fail = n_fail + 1
-            print "Failure #: " + str (n_fail)
-            print "HTTP Error:",e.code , url
-        except urllib2.URLError, e:
-            n_fail = n_fail + 1
-            print "Failure #: " + str (n_fail)
-            print "URL Error:",e.reason , url
-        except Exception,e: 
-            n_fail = n_fail + 1
-            print "Failure #: " + str (n_fail)
-            print str(e)
-    if n_fail > n_fail_max:
-        print "Download failed, giving up"
-    if file_age <= file_age_max_hours and file_size > 0:
-        print "Local file is new enough - skipping download"
-
 # Purpose: download the CSV file listing all stocks on the exchange
 # http://www.nasdaq.com/screening/companies-by-industry.aspx?exchange=NASDAQ&render=download
 
@@ -120,11 +72,14 @@ file3 = dir_input_screen + '/companylist-nasdaq.csv'
 file_age_max_hours = 12
 
 print ('Downloading list of AMEX stocks')
-download_page (url1, file1, file_age_max_hours)
+download_page_shared (url1, file1, file_age_max_hours, validator = fetch.validate_exchange_list)
 print ('Downloading list of NYSE stocks')
-download_page (url2, file2, file_age_max_hours)
+download_page_shared (url2, file2, file_age_max_hours, validator = fetch.validate_exchange_list)
 print ('Downloading list of NASDAQ stocks')
-download_page (url3, file3, file_age_max_hours)
+download_page_shared (url3, file3, file_age_max_hours, validator = fetch.validate_exchange_list)
+print fetch.flights.stats ()
+print fetch.invalid_stats ()
+print fetch.transfer_stats ()
 
 ##############################################################################################
 # PART 3: For a given exchange, obtain a list of ticker symbols for stocks that are NOT funds.